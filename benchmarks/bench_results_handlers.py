@@ -0,0 +1,183 @@
+"""Benchmarks of report building by the test results handlers against `MockEyesServer`.
+
+Every scenario builds the image tables of `--tests` synthetic sessions and
+reports wall time, wall time per test, requests/sec and peak Python memory::
+
+    python benchmarks/bench_results_handlers.py --tests 20 --output results.json
+
+CI keeps `results.json` of the main branch and fails on regressions::
+
+    python benchmarks/bench_results_handlers.py --compare results.json --tolerance 0.25
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import argparse
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from mock_eyes_server import MockEyesServer  # noqa: E402
+
+from EyesLibrary.ApplitoolsBase64TestResultHandler import (  # noqa: E402
+    ApplitoolsBase64TestResultHandler,
+)
+from EyesLibrary.config import (  # noqa: E402
+    ReportImageStorage,
+    TestResultsHandlerOptions,
+    ThumbnailFormat,
+)
+from EyesLibrary.http_session import ResultsHttpSession  # noqa: E402
+from EyesLibrary.image_downloader import ImageDownloader  # noqa: E402
+from EyesLibrary.image_processing import close_shared_image_encoder  # noqa: E402
+from EyesLibrary.report_assets import ReportAssets  # noqa: E402
+
+# report built by a handler per test: image links, base64 tables, or all tests
+# written into one stream by `write_base64_image_html`
+LINKS, TABLES, STREAM = "links", "tables", "stream"
+# name -> (TestResultsHandlerOptions kwargs, report mode)
+SCENARIOS = {
+    "links": ({}, LINKS),
+    "inline": ({}, TABLES),
+    "inline_stream": ({}, STREAM),
+    "assets_thumbnails": (
+        dict(report_image_storage=ReportImageStorage.assets, thumbnail_max_size=200),
+        TABLES,
+    ),
+    "inline_webp": (dict(report_image_format=ThumbnailFormat.WEBP), TABLES),
+    "assets": (dict(report_image_storage=ReportImageStorage.assets), TABLES),
+}
+# metrics compared against baseline, higher is worse
+COMPARED_METRICS = ("wall_time", "peak_memory")
+
+
+def run_scenario(server, name, tests, poll_delay):
+    # type: (MockEyesServer, str, int, float) -> dict
+    options_kwargs, mode = SCENARIOS[name]
+    options = TestResultsHandlerOptions(image_encoding_workers=0, **options_kwargs)
+    output_dir = tempfile.mkdtemp()
+    http = ResultsHttpSession.from_options(options)
+    downloader = ImageDownloader(options.max_workers)
+    report_assets = ReportAssets.from_options(options, output_dir)
+    server.reset_stats()
+    html_size = 0
+    tracemalloc.start()
+    started = time.time()
+    try:
+        if mode == STREAM:
+            test_results_list = server.test_results(tests)
+            handler = ApplitoolsBase64TestResultHandler(
+                test_results_list[0],
+                "mock-key",
+                http_session=http,
+                downloader=downloader,
+                options=options,
+                report_assets=report_assets,
+            )
+            handler.long_request_delay = poll_delay
+            stream = io.StringIO()
+            handler.write_base64_image_html(test_results_list, "mock-key", stream)
+            html_size = stream.tell()
+        else:
+            for test_results in server.test_results(tests):
+                handler = ApplitoolsBase64TestResultHandler(
+                    test_results,
+                    "mock-key",
+                    http_session=http,
+                    downloader=downloader,
+                    options=options,
+                    report_assets=report_assets,
+                )
+                handler.long_request_delay = poll_delay
+                if mode == LINKS:
+                    html = handler.get_image_table_rows_html()
+                else:
+                    html = handler.get_base64_table_rows_html()
+                html_size += len(html)
+        wall_time = time.time() - started
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        downloader.shutdown()
+        http.close()
+        close_shared_image_encoder()
+        shutil.rmtree(output_dir, ignore_errors=True)
+    return dict(
+        wall_time=wall_time,
+        wall_time_per_test=wall_time / tests,
+        requests=server.requests,
+        requests_per_sec=server.requests / wall_time if wall_time else 0.0,
+        peak_memory=peak_memory,
+        html_size=html_size,
+    )
+
+
+def compare(results, baseline, tolerance):
+    # type: (dict, dict, float) -> list
+    """Return descriptions of metrics worse than baseline by more than tolerance."""
+    regressions = []
+    for name, metrics in results.items():
+        for metric in COMPARED_METRICS:
+            base = baseline.get(name, {}).get(metric)
+            if base and metrics[metric] > base * (1 + tolerance):
+                regressions.append(
+                    "{} {}: {:.3f} > {:.3f} (+{:.0%})".format(
+                        name, metric, metrics[metric], base, metrics[metric] / base - 1
+                    )
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tests", type=int, default=10)
+    parser.add_argument("--steps", type=int, default=5)
+    parser.add_argument("--diff-every", type=int, default=2)
+    parser.add_argument("--image-size", type=int, nargs=2, default=(800, 600))
+    parser.add_argument("--latency", type=float, default=0.01)
+    parser.add_argument("--accepted-polls", type=int, default=1)
+    parser.add_argument("--poll-delay", type=float, default=0.01)
+    parser.add_argument(
+        "--scenario", action="append", choices=sorted(SCENARIOS), dest="scenarios"
+    )
+    parser.add_argument("--output", help="write results as JSON")
+    parser.add_argument("--compare", help="JSON results to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    results = {}
+    with MockEyesServer(
+        latency=args.latency,
+        steps=args.steps,
+        diff_every=args.diff_every,
+        image_size=tuple(args.image_size),
+        accepted_polls=args.accepted_polls,
+    ) as server:
+        for name in args.scenarios or sorted(SCENARIOS):
+            results[name] = run_scenario(server, name, args.tests, args.poll_delay)
+            print(
+                "{:<18} {wall_time:8.2f} s {wall_time_per_test:8.3f} s/test "
+                "{requests_per_sec:8.1f} req/s {peak_memory:>12,} B peak "
+                "{html_size:>12,} B html".format(name, **results[name])
+            )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
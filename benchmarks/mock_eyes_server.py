@@ -0,0 +1,286 @@
+"""Local stand-in for the Eyes server endpoints used by the test results handlers.
+
+Serves synthetic session JSON, step images and diff images behind the
+202 (accepted) -> 201 (created) -> DELETE long request flow, with
+configurable latency, image size and number of steps. Run it standalone::
+
+    python benchmarks/mock_eyes_server.py --port 8080 --latency 0.05
+
+or start it in process with `MockEyesServer(...).start()`.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import argparse
+import io
+import itertools
+import json
+import re
+import threading
+import time
+
+from six.moves import BaseHTTPServer, socketserver
+
+from PIL import Image
+
+__all__ = ("MockEyesServer", "SyntheticTestResults")
+
+_session_path = re.compile(r"^/api/sessions/batches/(?P<batch>\d+)/(?P<session>\d+)/?$")
+_diff_path = re.compile(
+    r"^/api/sessions/batches/(?P<batch>\d+)/(?P<session>\d+)/steps/(?P<step>\d+)/diff$"
+)
+_image_path = re.compile(r"^/api/images/(?P<image_id>[^/]+)/?$")
+_task_path = re.compile(r"^/tasks/(?P<task>\d+)$")
+_result_path = re.compile(r"^/results/(?P<task>\d+)$")
+
+
+def make_png(width, height):
+    # type: (int, int) -> bytes
+    """Noisy PNG of roughly realistic (poorly compressible) size."""
+    image = Image.effect_noise((width, height), 64).convert("RGB")
+    output = io.BytesIO()
+    image.save(output, format="PNG")
+    return output.getvalue()
+
+
+class _Step(object):
+    def __init__(self, url):
+        self.app_urls = type(str("AppUrls"), (object,), {"step": url})()
+        self.is_different = False
+
+
+class SyntheticTestResults(object):
+    """Stand-in of SDK `TestResults` with the attributes the handlers use."""
+
+    def __init__(self, server_url, batch_id, session_id, steps, diff_every=0):
+        self.url = "{}/app/batches/{}/{}?accountId=mock".format(
+            server_url, batch_id, session_id
+        )
+        self.steps = steps
+        self.steps_info = [
+            _Step("{}/app/step/{}".format(self.url, i + 1)) for i in range(steps)
+        ]
+        for i, step in enumerate(self.steps_info):
+            step.is_different = bool(diff_every) and (i + 1) % diff_every == 0
+        self.status = "Unresolved" if diff_every else "Passed"
+        self.user_test_id = "{}-{}".format(batch_id, session_id)
+
+
+class MockEyesServer(object):
+    """Threaded HTTP server imitating Eyes session, image and diff endpoints.
+
+    :param latency: seconds every response is delayed by
+    :param steps: number of steps of every session
+    :param diff_every: every n-th step is mismatching and has a diff image
+    :param image_size: (width, height) of served images
+    :param accepted_polls: 202 responses of a diff task before it is created
+    :param gone_steps: steps whose diff task answers 410 Gone
+    """
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        latency=0.0,
+        steps=5,
+        diff_every=2,
+        image_size=(800, 600),
+        accepted_polls=1,
+        gone_steps=(),
+    ):
+        self.latency = latency
+        self.steps = steps
+        self.diff_every = diff_every
+        self.accepted_polls = accepted_polls
+        self.gone_steps = set(gone_steps)
+        self.image = make_png(*image_size)
+        self.requests = 0
+        self._tasks = {}  # task id -> [polls left, step]
+        self._task_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._httpd = _ThreadingHTTPServer((host, port), _Handler)
+        self._httpd.mock = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def start(self):
+        # type: () -> MockEyesServer
+        self._thread = threading.Thread(target=self._httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        # type: () -> None
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def reset_stats(self):
+        with self._lock:
+            self.requests = 0
+
+    def test_results(self, count, batch_id="1000"):
+        """Return `count` synthetic test results of sessions served by this server."""
+        return [
+            SyntheticTestResults(
+                self.url, batch_id, str(2000 + i), self.steps, self.diff_every
+            )
+            for i in range(count)
+        ]
+
+    def session_json(self, session_id):
+        steps = range(self.steps)
+        return {
+            "scenarioName": "Mock test {}".format(session_id),
+            "status": "Unresolved" if self.diff_every else "Passed",
+            "startInfo": {
+                "scenarioName": "Mock test {}".format(session_id),
+                "environment": {
+                    "osInfo": "Linux",
+                    "hostingAppInfo": "Chrome",
+                    "displaySize": {"width": 800, "height": 600},
+                },
+            },
+            "baselineEnv": {"hostingApp": "Chrome"},
+            "expectedAppOutput": [
+                {
+                    "tag": "step {}".format(i + 1),
+                    "image": {"id": "b{}-{}".format(session_id, i)},
+                }
+                for i in steps
+            ],
+            "actualAppOutput": [
+                {
+                    "tag": "step {}".format(i + 1),
+                    "isMatching": not self._is_diff_step(i + 1),
+                    "image": {"id": "c{}-{}".format(session_id, i)},
+                }
+                for i in steps
+            ],
+        }
+
+    def _is_diff_step(self, step):
+        return bool(self.diff_every) and step % self.diff_every == 0
+
+    def new_task(self, step):
+        with self._lock:
+            task_id = next(self._task_ids)
+            self._tasks[task_id] = [self.accepted_polls, step]
+        return task_id
+
+    def poll_task(self, task_id):
+        """Return status the diff task answers with to this poll."""
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is None:
+                return 404
+            if task[1] in self.gone_steps:
+                return 410
+            if task[0] > 0:
+                task[0] -= 1
+                return 202
+            return 201
+
+    def finish_task(self, task_id):
+        with self._lock:
+            return self._tasks.pop(task_id, None) is not None
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def mock(self):
+        # type: () -> MockEyesServer
+        return self.server.mock
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=b"", content_type=None, location=None):
+        self.send_response(status)
+        if content_type:
+            self.send_header("Content-Type", content_type)
+        if location:
+            self.send_header("Location", self.mock.url + location)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _begin(self):
+        with self.mock._lock:
+            self.mock.requests += 1
+        if self.mock.latency:
+            time.sleep(self.mock.latency)
+        return self.path.split("?")[0]
+
+    def do_GET(self):
+        path = self._begin()
+        match = _session_path.match(path)
+        if match:
+            body = json.dumps(self.mock.session_json(match.group("session")))
+            return self._send(200, body.encode("utf-8"), "application/json")
+        if _image_path.match(path):
+            return self._send(200, self.mock.image, "image/png")
+        match = _diff_path.match(path)
+        if match:
+            task_id = self.mock.new_task(int(match.group("step")))
+            return self._send(202, location="/tasks/{}".format(task_id))
+        match = _task_path.match(path)
+        if match:
+            task_id = int(match.group("task"))
+            status = self.mock.poll_task(task_id)
+            if status == 201:
+                return self._send(201, location="/results/{}".format(task_id))
+            return self._send(status)
+        self._send(404)
+
+    def do_DELETE(self):
+        path = self._begin()
+        match = _result_path.match(path)
+        if match and self.mock.finish_task(int(match.group("task"))):
+            return self._send(200, self.mock.image, "image/png")
+        self._send(404)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--steps", type=int, default=5)
+    parser.add_argument("--diff-every", type=int, default=2)
+    parser.add_argument("--image-size", type=int, nargs=2, default=(800, 600))
+    parser.add_argument("--accepted-polls", type=int, default=1)
+    args = parser.parse_args()
+    server = MockEyesServer(
+        args.host,
+        args.port,
+        args.latency,
+        args.steps,
+        args.diff_every,
+        tuple(args.image_size),
+        args.accepted_polls,
+    )
+    print("Mock Eyes server listening on {}".format(server.url))
+    try:
+        server._httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,23 @@
 import os
 import base64
-
-import requests
-
-from .ApplitoolsTestResultHandler import ApplitoolsTestResultsHandler, ResultStatus
+import hashlib
+from collections import Counter
+from email.utils import formatdate
+
+from applitools.common.test_results import TestResultsStatus
+
+from .ApplitoolsTestResultHandler import ApplitoolsTestResultsHandler
+from .config import ReportImages, ReportImageStorage
+from .http_session import CircuitOpenError
+from .image_downloader import get_shared_downloader
+from .image_processing import (IMAGE_FORMAT_TO_EXTENSION, IMAGE_FORMAT_TO_MIME_TYPE, encode_image,
+                               get_shared_image_encoder, make_thumbnail, sniff_image_format)
+from .report_assets import get_shared_report_assets
 import robot.api.logger as robot_logger
 
 
 class ApplitoolsBase64TestResultHandler(ApplitoolsTestResultsHandler):
 
-    _step_states = None
     _table_template_html = '''<table width="600" style="width:600px;">
                             <th colspan="5">{table_title}</th>
                             <tr>
@@ -21,8 +29,11 @@ class ApplitoolsBase64TestResultHandler(ApplitoolsTestResultsHandler):
                             </tr>
                             {step_image_table_rows}
                         </table>'''
+    # head and tail of the table template for the streamed output
+    _table_head_html, _, _table_tail_html = _table_template_html.partition('{step_image_table_rows}')
 
     _table_title_template = '{test_name} - {host_os} - {host_app} - {display_width} x {display_height} - ({status})'
+    _links_table_title_template = '{test_name} - {host_os} - {host_app} - (Eyes session unavailable)'
 
     _image_url_template = '{server_url}/api/images/{image_id}'
     _image_link_template = '{server_url}/api/images/{image_id}/?apiKey={api_key}'
@@ -43,6 +54,20 @@ class ApplitoolsBase64TestResultHandler(ApplitoolsTestResultsHandler):
                         'style="display: block;width: 100%;object-fit: contain; cursor: pointer;border: 1px solid ' \
                         '#0000EE;"></td> '
 
+    _image_linked_html = '<td style="width: 20%;padding: 2% 5% 2% 5%;text-align: center;"><a href="{full_image_url}" ' \
+                         'target="_blank"><img src="{image_url}" loading="lazy" style="display: block;width: 100%;' \
+                         'object-fit: contain;border: 1px solid #0000EE;"></a></td> '
+
+    # Images repeated in one table are emitted once into hidden asset table and
+    # cells copy them from there, 1x1 gif is shown until then
+    _asset_table_html = '<div style="display: none;">{asset_images}</div>'
+    _asset_image_html = '<img id="eyes-asset-{asset_id}" src="{image_src}">'
+    _asset_reference_attrs = 'src="data:image/gif;base64,R0lGODlhAQABAIAAAP///wAAACH5BAEAAAAALAAAAAABAAEAAAICRAEAOw==" ' \
+                             'onload="this.removeAttribute(\'onload\');' \
+                             'this.src=document.getElementById(\'eyes-asset-{asset_id}\').src;"'
+    _image_popup_ref_html = _image_popup_html.replace('src="{base64_url}"', _asset_reference_attrs)
+    _image_linked_ref_html = _image_linked_html.replace('src="{image_url}"', _asset_reference_attrs)
+
     _image_download_html = '<td style="width: 20%;padding: 2% 5% 2% 5%;text-align: center;"><a ' \
                            'href="{base64_url}" download="{filename}"><img ' \
                            'id="{image_id}" src="{base64_url}" style="display: ' \
@@ -52,11 +77,20 @@ class ApplitoolsBase64TestResultHandler(ApplitoolsTestResultsHandler):
                             'image_url}"><img id="{image_id}" src="{image_url}" style="display: block;width: ' \
                             '100%;object-fit: contain;"></a></td> '
 
+    _image_kinds = ('baseline', 'checkpoint', 'diff')
+    _empty_image_messages = {'baseline': "No Baseline Image",
+                             'checkpoint': "No Checkpoint Image",
+                             'diff': "No Diff Image"}
+
     _empty_image_cell_html = '<td style="width: 20%;padding: 2% 5% 2% 5%;text-align: center;">{message}</td>'
 
-    def __init__(self, test_results, view_key):
-        super().__init__(test_results, view_key)
-        self._step_states = self.calculate_step_results()
+    def __init__(self, test_results, view_key, *, http_session=None, downloader=None, image_cache=None,
+                 options=None, report_assets=None, test_json=None):
+        super().__init__(test_results, view_key, http_session=http_session, image_cache=image_cache,
+                         options=options, test_json=test_json)
+        self.downloader = downloader if downloader is not None else get_shared_downloader()
+        self.report_assets = report_assets if report_assets is not None else get_shared_report_assets()
+        self.image_encoder = get_shared_image_encoder(self.options)
         if(os.environ.get('APPLITOOLS_REQUEST_DELAY') is not None and os.environ.get('APPLITOOLS_REQUEST_DELAY').isnumeric()):
             self.long_request_delay = int(os.environ.get('APPLITOOLS_REQUEST_DELAY'))
         else:
@@ -77,146 +111,330 @@ class ApplitoolsBase64TestResultHandler(ApplitoolsTestResultsHandler):
         return request
 
     def get_table_title(self, step_index=None):
-        step_result = ''
+        session = self.session
         if(step_index == None):
-            step_result = self.test_JSON["status"]
+            step_result = session.status
         else:
-            step_result = str(self._step_states[step_index]).replace('ResultStatus.', '')
-
-        test_name = self.test_JSON["startInfo"]['scenarioName']
-        host_os = self.test_JSON["startInfo"]["environment"]['osInfo']
-        host_app = self.test_JSON["startInfo"]["environment"]['hostingAppInfo']
-        display_width = self.test_JSON["startInfo"]["environment"]['displaySize']['width']
-        display_height = self.test_JSON["startInfo"]["environment"]['displaySize']['height']
-        return self._table_title_template.format(test_name=test_name, host_os=host_os, host_app=host_app,
-                                                 display_width=display_width, display_height=display_height, 
-                                                 status=step_result)
+            step_result = session.step_states[step_index].name
+        return self._table_title_template.format(test_name=session.test_name, host_os=session.host_os,
+                                                 host_app=session.host_app, display_width=session.display_width,
+                                                 display_height=session.display_height, status=step_result)
 
 
     def image_from_url_to_base64(self, url):
-        with self.send_long_request('GET', url) as resp:
-            resp.raw.decode_content = True
-            base64_url = "data:image/png;base64," + base64.b64encode(resp.content).decode('utf-8')
-            return base64_url
-
-    def get_base64_diff_image_list(self, step_number = None):
+        content, mime_type, _ = self.encode_report_image(self.image_content_from_url(url))
+        return self.content_to_base64(content, mime_type)
+
+    @staticmethod
+    def content_to_base64(content, mime_type='image/png'):
+        base64_url = "data:" + mime_type + ";base64," + base64.b64encode(content).decode('utf-8')
+        return base64_url
+
+    def use_report_assets(self):
+        return (self.options.report_image_storage is ReportImageStorage.assets and
+                self.report_assets is not None)
+
+    def use_thumbnails(self):
+        # full size image of an inline thumbnail could only be linked with the api key
+        return bool(self.options.thumbnail_max_size) and self.use_report_assets()
+
+    def create_thumbnail(self, content):
+        return self.image_encoder.run(make_thumbnail, content, self.options.thumbnail_max_size,
+                                      self.options.thumbnail_format, self.options.thumbnail_quality)
+
+    def use_image_encoding(self):
+        return self.options.report_image_format is not None
+
+    def encode_report_image(self, content):
+        """Return (content, mime type, extension) of the image as it goes into report"""
+        image_format = self.options.report_image_format
+        if image_format is None:
+            extension, mime_type = sniff_image_format(content[:16])
+            return content, mime_type, extension
+        content = self.image_encoder.run(encode_image, content, image_format, self.options.report_image_quality)
+        return content, IMAGE_FORMAT_TO_MIME_TYPE[image_format], IMAGE_FORMAT_TO_EXTENSION[image_format]
+
+    def get_thumbnail_asset_name(self, name):
+        return name + '.thumb.' + IMAGE_FORMAT_TO_EXTENSION[self.options.thumbnail_format]
+
+    def get_asset_report_image(self, name):
+        full_image_link = self.report_assets.link(name)
+        if not self.use_thumbnails():
+            return full_image_link, full_image_link
+        thumbnail_name = self.get_thumbnail_asset_name(name)
+        if not self.report_assets.exists(thumbnail_name):
+            with open(self.report_assets.path(name), 'rb') as f:
+                self.report_assets.write(thumbnail_name, self.create_thumbnail(f.read()))
+        return self.report_assets.link(thumbnail_name), full_image_link
+
+    def image_from_url_to_asset(self, url):
+        name = self.report_assets.get_alias(url)
+        if name is None:
+            if self.use_image_encoding():
+                # image is re-encoded in memory anyway
+                return self.content_to_report_image(url, self.image_content_from_url(url))
+            tmp_path = self.report_assets.temp_path()
+            try:
+                image_id = self.get_image_id_from_url(url)
+                if image_id is not None:
+                    self.image_from_id_to_file(image_id, tmp_path)
+                else:
+                    self.image_from_url_to_file(url, tmp_path)
+                with open(tmp_path, 'rb') as f:
+                    extension, _ = sniff_image_format(f.read(16))
+                name = self.report_assets.add_file(tmp_path, alias=url, extension=extension)
+            finally:
+                # left behind only if the download failed, assets dir is published with the log
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        return self.get_asset_report_image(name)
+
+    def image_from_url_to_report_image(self, url):
+        """Return (src, full size link) of the report image.
+
+        `src` is a relative asset link or base64 data url, full size link is None
+        when `src` already is the full size image.
+        """
+        if self.use_report_assets():
+            return self.image_from_url_to_asset(url)
+        return self.content_to_report_image(url, self.image_content_from_url(url))
+
+    def content_to_report_image(self, url, content):
+        if self.use_report_assets():
+            content, _, extension = self.encode_report_image(content)
+            name = self.report_assets.add(content, alias=url, extension=extension)
+            return self.get_asset_report_image(name)
+        content, mime_type, _ = self.encode_report_image(content)
+        return self.content_to_base64(content, mime_type), None
+
+    def get_report_image_cell_html(self, report_image, asset_id=None):
+        image_src, full_image_url = report_image
+        if full_image_url is None:
+            if asset_id is not None:
+                return self._image_popup_ref_html.format(asset_id=asset_id)
+            return self._image_popup_html.format(base64_url=image_src)
+        if asset_id is not None:
+            return self._image_linked_ref_html.format(asset_id=asset_id, full_image_url=full_image_url)
+        return self._image_linked_html.format(image_url=image_src, full_image_url=full_image_url)
+
+    def get_shared_report_images(self, image_list):
+        """Return {src: asset id} of inline images used more than once in `image_list`.
+
+        Images are shared within one table only: propagated results put each
+        step table into its own log.html message and those are rendered
+        lazily, so an image of another message may not be in the page."""
+        if self.use_report_assets():
+            # asset files are deduplicated on disk already
+            return {}
+        image_counts = Counter(step_image_dict[image_kind][0]
+                               for step_image_dict in image_list
+                               for image_kind in self._image_kinds
+                               if step_image_dict[image_kind] is not None)
+        return dict((image_src, hashlib.sha1(image_src.encode('utf-8')).hexdigest())
+                    for image_src, count in image_counts.items() if count > 1)
+
+    def get_asset_table_html(self, shared_images):
+        if not shared_images:
+            return ''
+        return self._asset_table_html.format(
+            asset_images=''.join(self._asset_image_html.format(asset_id=asset_id, image_src=image_src)
+                                 for image_src, asset_id in shared_images.items()))
+
+    def should_report_step_images(self, step_index):
+        """Whether images of the step are retrieved according to `report_images` policy"""
+        policy = self.options.report_images
+        if policy is ReportImages.all:
+            return True
+        # same decision as the listener makes from data returned by SDK
+        if policy is ReportImages.failed_only:
+            return self.test_results.status != TestResultsStatus.Passed
+        if policy is ReportImages.diffs_only:
+            return self.test_results.steps_info[step_index].is_different
+        return False
+
+    def get_step_image_url_list(self, step_number=None):
         image_list = list()
-        if(self._step_states == None):
-            self._step_states = self.calculate_step_results()
+        session = self.session
 
         file_name_prefix = self.batch_ID + '_' + self.session_ID
 
         step_range = []
 
         if(step_number == None):
-            step_range = range(len(self._step_states))
+            step_range = range(len(session))
         else:
             step_range = [step_number - 1]
 
         for i in step_range:
             tag = None
-            step_base64_dict = {'baseline': None, 'checkpoint': None, 'diff': None,
-                                'file_prefix': file_name_prefix + '_' + str(i + 1)}
-            if self._step_states[i] is ResultStatus.PASSED or self._step_states[i] is ResultStatus.FAILED or \
-                    self._step_states[i] is ResultStatus.MISSING:
+            image_url_dict = {'baseline': None, 'checkpoint': None, 'diff': None,
+                              'file_prefix': file_name_prefix + '_' + str(i + 1)}
+            if session.has_baseline(i):
                 # Set step tag/label, if we have a baseline
-                tag = self.test_JSON["expectedAppOutput"][i]['tag']
+                tag = session.baseline_tags[i]
 
                 image_id = self.get_image_id("expectedAppOutput", i)
                 if image_id is not None:
-                    baseline_image_url = self._image_url_template.format(server_url=self.server_URL, image_id=image_id)
-                    step_base64_dict['baseline'] = self.image_from_url_to_base64(baseline_image_url)
+                    image_url_dict['baseline'] = self._image_url_template.format(server_url=self.server_URL,
+                                                                                 image_id=image_id)
+
+            image_url_dict['tag'] = tag
 
-            step_base64_dict['tag'] = tag
+            if not self.should_report_step_images(i):
+                image_url_dict['baseline'] = None
+                image_url_dict['skipped'] = True
+                image_list.append(image_url_dict)
+                continue
 
-            if self._step_states[i] is ResultStatus.PASSED or self._step_states[i] is ResultStatus.FAILED or \
-                    self._step_states[i] is ResultStatus.NEW:
+            if session.has_checkpoint(i):
                 image_id = self.get_image_id("actualAppOutput", i)
                 if image_id is not None:
-                    checkpoint_image_url = self._image_url_template.format(server_url=self.server_URL,
-                                                                           image_id=image_id)
-                    step_base64_dict['checkpoint'] = self.image_from_url_to_base64(checkpoint_image_url)
+                    image_url_dict['checkpoint'] = self._image_url_template.format(server_url=self.server_URL,
+                                                                                   image_id=image_id)
 
-            if self._step_states[i] is ResultStatus.FAILED:
-                diff_image_url = self._diff_image_url_template.format(server_url=self.server_URL,
-                                                                      batch_id=self.batch_ID,
-                                                                      session_id=self.session_ID,
-                                                                      step_number=str(i + 1))
-                
-                step_base64_dict['diff'] = self.image_from_url_to_base64(diff_image_url)
+            if session.is_failed(i):
+                image_url_dict['diff'] = self._diff_image_url_template.format(server_url=self.server_URL,
+                                                                              batch_id=self.batch_ID,
+                                                                              session_id=self.session_ID,
+                                                                              step_number=str(i + 1))
 
-            image_list.append(step_base64_dict)
+            image_list.append(image_url_dict)
 
         return image_list
 
-    def get_base64_table_rows_html(self, step_number=None):
-        image_list = []
+    def prefetch_base64_images(self, step_number=None):
+        """Start downloading images of the test (or of a single step) in background."""
+        for image_url in self.get_step_image_urls(step_number):
+            self.downloader.submit(image_url, self.image_from_url_to_report_image)
+
+    def harvest_images(self):
+        """Download images of the test into report assets or the image cache,
+        so they cost no download when the report is built and aren't held in memory"""
+        for image_url in self.get_step_image_urls():
+            if self.use_report_assets():
+                self.image_from_url_to_asset(image_url)
+            else:
+                self.image_content_from_url(image_url)
 
+    def get_base64_diff_image_list(self, step_number = None):
+        image_list = self.get_step_image_url_list(step_number)
+        # submit every image first, so the whole test is downloaded concurrently
+        self.prefetch_base64_images(step_number)
+
+        # `result` forgets the image, so a url repeated in the test is resolved once
+        report_images = {}
+        for step_base64_dict in image_list:
+            for image_kind in self._image_kinds:
+                image_url = step_base64_dict[image_kind]
+                if image_url is not None:
+                    if image_url not in report_images:
+                        report_images[image_url] = self.get_report_image(image_url)
+                    step_base64_dict[image_kind] = report_images[image_url]
+
+        return image_list
+
+    def get_report_image(self, image_url):
+        try:
+            return self.downloader.result(image_url, self.image_from_url_to_report_image)
+        except CircuitOpenError:
+            # prefetched while the circuit was open, the failed download is forgotten
+            # so it's submitted again, it's the trial request once reset timeout passed
+            return self.downloader.result(image_url, self.image_from_url_to_report_image)
+
+    def get_step_image_urls(self, step_number=None):
+        """Return urls of report images of the test (or of a single step)"""
+        return [image_url_dict[image_kind]
+                for image_url_dict in self.get_step_image_url_list(step_number)
+                for image_kind in self._image_kinds
+                if image_url_dict[image_kind] is not None]
+
+    def release_prefetched_images(self):
+        """Drop images of the test that were prefetched but not rendered,
+        e.g. of steps missing in the rendered results or of tables linking images"""
+        self.downloader.discard(self.get_step_image_urls())
+
+    def get_base64_table_rows_html(self, step_number=None):
+        return ''.join(self.iter_base64_table_rows_html(step_number))
+
+    def iter_base64_table_rows_html(self, step_number=None):
+        """Yield html of the test (or step) image table fragment by fragment,
+        falls back to dashboard links when images can't be downloaded"""
+        image_list = None
+        if not self.http.breaker.is_open and not self.http.deadline_passed:
+            try:
+                if(step_number == None):
+                    table_header = self.get_table_title()
+                    robot_logger.console('Downloading images for Test: ' + table_header + '...')
+                    image_list = self.get_base64_diff_image_list()
+                else:
+                    table_header = self.get_table_title(step_number - 1)
+                    robot_logger.console('Downloading images for Step ' + str(step_number) + ' of Test: ' +
+                                         table_header + '...')
+                    image_list = self.get_base64_diff_image_list(step_number)
+            except Exception as e:
+                robot_logger.warn("Failed to download Eyes images, linking dashboard instead: {}".format(e))
+        if image_list is None:
+            # image links would carry the api key into the report
+            step_numbers = [step_number] if step_number is not None else \
+                range(1, len(self.test_results.steps_info) + 1)
+            for number in step_numbers:
+                for html in self.iter_step_links_table_html(self.test_results, number,
+                                                            self.get_table_title(number - 1)):
+                    yield html
+            return
+
+        shared_images = self.get_shared_report_images(image_list)
+
+        def image_cell_html(image_kind, report_image):
+            return self.get_report_image_cell_html(report_image, shared_images.get(report_image[0]))
+
+        yield self.get_asset_table_html(shared_images)
+        yield self._table_head_html.format(table_title=table_header)
+        for row_html in self._iter_step_rows_html(image_list, step_number, image_cell_html):
+            yield row_html
+        yield self._table_tail_html
+
+    def _iter_step_rows_html(self, image_list, step_number, image_cell_html):
         step_number_tag = ""
         step_url = ""
-        table_header = ""
-        
-        if(step_number == None):
-            table_header = self.get_table_title()
-            robot_logger.console('Downloading images for Test: ' + table_header + '...')
-            image_list = self.get_base64_diff_image_list()
-        else:
+        if(step_number != None):
             step_number_tag = str(step_number)
-            table_header = self.get_table_title(step_number - 1)
-            robot_logger.console('Downloading images for Step ' + step_number_tag + ' of Test: ' + table_header + '...')
-            image_list = self.get_base64_diff_image_list(step_number)
             step_url = self.test_results.steps_info[step_number - 1].app_urls.step
 
-        
-        output_html = ''
         for i in range(len(image_list)):
             if(step_number == None):
                 step_number_tag = str(i + 1)
                 step_url = self.test_results.steps_info[i].app_urls.step
 
-            output_html += "<tr>"
+            yield "<tr>"
 
             if image_list[i]['tag'] is not None:
-                output_html += self._step_name_cell_html.format(step_tag=step_number_tag + ' - ' + image_list[i]['tag'])
-            else:
-                output_html += self._step_name_cell_html.format(step_tag=step_number_tag)
-
-            if image_list[i]['baseline'] is not None:
-                output_html += self._image_popup_html.format(base64_url=image_list[i]['baseline'])
-            else:
-                output_html += self._empty_image_cell_html.format(message="No Baseline Image")
-
-            if image_list[i]['checkpoint'] is not None:
-                output_html += self._image_popup_html.format(base64_url=image_list[i]['checkpoint'],
-                                                                filename=image_list[i]['file_prefix'] + "_check.png",
-                                                                image_id="checkpointImage")
-            else:
-                output_html += self._empty_image_cell_html.format(message="No Checkpoint Image")
-
-            if image_list[i]['diff'] is not None:
-                output_html += self._image_popup_html.format(base64_url=image_list[i]['diff'],
-                                                                filename=image_list[i]['file_prefix'] + "_diff.png",
-                                                                image_id="diffImage")
+                yield self._step_name_cell_html.format(step_tag=step_number_tag + ' - ' + image_list[i]['tag'])
             else:
-                output_html += self._empty_image_cell_html.format(message="No Diff Image")
+                yield self._step_name_cell_html.format(step_tag=step_number_tag)
 
-            output_html += self._step_link_template.format(step_url=step_url)
+            for image_kind in self._image_kinds:
+                if image_list[i][image_kind] is not None:
+                    yield image_cell_html(image_kind, image_list[i][image_kind])
+                elif image_list[i].get('skipped'):
+                    yield self._empty_image_cell_html.format(message="Image not retrieved")
+                else:
+                    yield self._empty_image_cell_html.format(message=self._empty_image_messages[image_kind])
 
-            output_html += "</tr><br><br>"
+            yield self._step_link_template.format(step_url=step_url)
 
-        return self._table_template_html.format(table_title=table_header, step_image_table_rows=output_html)
+            yield "</tr><br><br>"
 
     def get_test_image_urls(self, step_number = None):
         image_list = list()
-        if(self._step_states == None):
-            self._step_states = self.calculate_step_results()
+        session = self.session
 
         file_name_prefix = self.batch_ID + '_' + self.session_ID
 
         step_range = []
 
         if(step_number == None):
-            step_range = range(len(self._step_states))
+            step_range = range(len(session))
         else:
             step_range = [step_number - 1]
 
@@ -225,10 +443,9 @@ class ApplitoolsBase64TestResultHandler(ApplitoolsTestResultsHandler):
             tag = None
             image_url_dict = {'baseline': None, 'checkpoint': None, 'diff': None,
                               'file_prefix': file_name_prefix + '_' + str(i + 1)}
-            if self._step_states[i] is ResultStatus.PASSED or self._step_states[i] is ResultStatus.FAILED or \
-                    self._step_states[i] is ResultStatus.MISSING:
+            if session.has_baseline(i):
                 # Set step tag/label, if we have a baseline
-                tag = self.test_JSON["expectedAppOutput"][i]['tag']
+                tag = session.baseline_tags[i]
                 image_id = self.get_image_id("expectedAppOutput", i)
                 if image_id is not None:
                     image_url_dict['baseline'] = self._image_link_template.format(server_url=self.server_URL,
@@ -236,101 +453,106 @@ class ApplitoolsBase64TestResultHandler(ApplitoolsTestResultsHandler):
                                                                                   api_key=self.view_key)
             image_url_dict['tag'] = tag
 
-            if self._step_states[i] is ResultStatus.PASSED or self._step_states[i] is ResultStatus.FAILED or \
-                    self._step_states[i] is ResultStatus.NEW:
+            if session.has_checkpoint(i):
                 image_id = self.get_image_id("actualAppOutput", i)
                 if image_id is not None:
                     image_url_dict['checkpoint'] = self._image_link_template.format(server_url=self.server_URL,
                                                                                     image_id=image_id,
                                                                                     api_key=self.view_key)
 
-            if self._step_states[i] is ResultStatus.FAILED:
+            if session.is_failed(i):
                 image_url_dict['diff'] = self.server_URL + '/api/sessions/batches/' + \
                                          self.batch_ID + '/' + self.session_ID + \
                                          '/steps/' + str(i + 1) + '/diff' + "?apiKey=" + self.view_key
-            else:
-                print("No Diff image in step " + str(i + 1) + '\n')
 
             image_list.append(image_url_dict)
 
         return image_list
 
     def get_image_table_rows_html(self, step_number=None):
-        image_list = []
-        
-        step_number_tag = ""
-        step_url = ""
-        table_header = ""
-        
+        return ''.join(self.iter_image_table_rows_html(step_number))
+
+    def iter_image_table_rows_html(self, step_number=None):
+        """Yield html of the test (or step) image links table fragment by fragment"""
         if(step_number == None):
             table_header = self.get_table_title()
             robot_logger.console('Downloading images for Test: ' + table_header + '...')
             image_list = self.get_test_image_urls()
         else:
-            step_number_tag = str(step_number)
             table_header = self.get_table_title(step_number - 1)
-            robot_logger.console('Downloading images for Step ' + step_number_tag + ' of Test: ' + table_header + '...')
+            robot_logger.console('Downloading images for Step ' + str(step_number) + ' of Test: ' + table_header + '...')
             image_list = self.get_test_image_urls(step_number)
-            step_url = self.test_results.steps_info[step_number - 1].app_urls.step
-
-        output_html = ''
-
-        for i in range(len(image_list)):
-
-            if(step_number == None):
-                step_number_tag = str(i + 1)
-                step_url = self.test_results.steps_info[i].app_urls.step
-
-            output_html += "<tr>"
-
-            if image_list[i]['tag'] is not None:
-                output_html += self._step_name_cell_html.format(step_tag=step_number_tag + ' - ' + image_list[i]['tag'])
-            else:
-                output_html += self._step_name_cell_html.format(step_tag=step_number_tag)
-
-            if image_list[i]['baseline'] is not None:
-                output_html += self._image_link_cell_html.format(image_url=image_list[i]['baseline'],
-                                                                 image_id="baselineImage")
-            else:
-                output_html += self._empty_image_cell_html.format(message="No Baseline Image")
 
-            if image_list[i]['checkpoint'] is not None:
-                output_html += self._image_link_cell_html.format(image_url=image_list[i]['checkpoint'],
-                                                                 image_id="checkpointImage")
-            else:
-                output_html += self._empty_image_cell_html.format(message="No Checkpoint Image")
-
-            if image_list[i]['diff'] is not None:
-                output_html += self._image_link_cell_html.format(image_url=image_list[i]['diff'],
-                                                                 image_id="diffImage")
-            else:
-                output_html += self._empty_image_cell_html.format(message="No Diff Image")
-
-            output_html += self._step_link_template.format(step_url=step_url)
-
-            output_html += "</tr><br><br>"
-
-        return self._table_template_html.format(table_title=table_header, step_image_table_rows=output_html)
-
-    def get_image_html(self, view_key):
-        image_html = ''
-        for test_result in self._test_results:
-            html_test_result_handler = ApplitoolsBase64TestResultHandler(test_result, view_key)
+        def image_cell_html(image_kind, image_url):
+            return self._image_link_cell_html.format(image_url=image_url, image_id=image_kind + "Image")
+
+        yield self._table_head_html.format(table_title=table_header)
+        for row_html in self._iter_step_rows_html(image_list, step_number, image_cell_html):
+            yield row_html
+        yield self._table_tail_html
+
+    @classmethod
+    def iter_step_links_table_html(cls, test_results, step_number, table_title=None):
+        """Yield html of the step table linking the dashboard, built from the test
+        results returned by SDK only, e.g. for sessions whose JSON can't be retrieved"""
+        step_info = test_results.steps_info[step_number - 1]
+        if table_title is None:
+            table_title = cls._links_table_title_template.format(
+                test_name=test_results.name, host_os=test_results.host_os, host_app=test_results.host_app)
+        yield cls._table_head_html.format(table_title=table_title)
+        yield "<tr>"
+        if step_info.name:
+            yield cls._step_name_cell_html.format(step_tag=str(step_number) + ' - ' + step_info.name)
+        else:
+            yield cls._step_name_cell_html.format(step_tag=str(step_number))
+        for _ in cls._image_kinds:
+            yield cls._empty_image_cell_html.format(message="Image not retrieved")
+        yield cls._step_link_template.format(step_url=step_info.app_urls.step)
+        yield "</tr><br><br>"
+        yield cls._table_tail_html
+
+    def create_test_handler(self, test_result, view_key):
+        """Return handler of another test sharing collaborators and settings of this one"""
+        handler = ApplitoolsBase64TestResultHandler(test_result, view_key, http_session=self.http,
+                                                    downloader=self.downloader, image_cache=self.image_cache,
+                                                    options=self.options, report_assets=self.report_assets)
+        handler.long_request_delay = self.long_request_delay
+        return handler
+
+    def get_image_html(self, test_results_list, view_key):
+        return ''.join(self.iter_image_html(test_results_list, view_key))
+
+    def iter_image_html(self, test_results_list, view_key):
+        for test_result in test_results_list:
+            html_test_result_handler = self.create_test_handler(test_result, view_key)
             robot_logger.info("Retrieving Image Links for APPLITOOLS Test: " +
                               str(html_test_result_handler.get_table_title()), False, True)
-            image_html += html_test_result_handler.get_image_table_rows_html()
-        self._test_results.clear()
-        return image_html
-
-    def get_base64_image_html(self, view_key):
-        base64_image_html = ''
-        for test_result in self._test_results:
-            base64_test_result_handler = ApplitoolsBase64TestResultHandler(test_result, view_key)
-            robot_logger.info("Retrieving Images for APPLITOOLS Test: " +
-                              str(base64_test_result_handler.get_table_title()), False, True)
-            base64_image_html += base64_test_result_handler.get_base64_table_rows_html()
-        self._test_results.clear()
-        return base64_image_html
-
-    def log_image_html(self, view_key):
-        robot_logger.write(self.get_base64_image_html(view_key), html=True, level='ERROR')
\ No newline at end of file
+            for html in html_test_result_handler.iter_image_table_rows_html():
+                yield html
+
+    def get_base64_image_html(self, test_results_list, view_key):
+        return ''.join(self.iter_base64_image_html(test_results_list, view_key))
+
+    def iter_base64_image_html(self, test_results_list, view_key):
+        """Yield html of all tests, only one test table is built at a time"""
+        for test_result in test_results_list:
+            for html in self.iter_test_base64_image_html(test_result, view_key):
+                yield html
+
+    def iter_test_base64_image_html(self, test_result, view_key):
+        base64_test_result_handler = self.create_test_handler(test_result, view_key)
+        robot_logger.info("Retrieving Images for APPLITOOLS Test: " +
+                          str(base64_test_result_handler.get_table_title()), False, True)
+        for html in base64_test_result_handler.iter_base64_table_rows_html():
+            yield html
+
+    def write_base64_image_html(self, test_results_list, view_key, stream):
+        """Write html of all tests into file-like `stream` without keeping it in memory"""
+        for html in self.iter_base64_image_html(test_results_list, view_key):
+            stream.write(html)
+
+    def log_image_html(self, test_results_list, view_key):
+        # one log message per test, so html of all tests is never held at once
+        for test_result in test_results_list:
+            robot_logger.write(''.join(self.iter_test_base64_image_html(test_result, view_key)),
+                               html=True, level='ERROR')
@@ -1,108 +1,109 @@
 import re
 import time
-from math import floor
+import json
 
 import logging
-import requests
 import shutil
 import os
-from enum import Enum
+import tempfile
 from enum import IntEnum
 from email.utils import formatdate
 
+from .config import TestResultsHandlerOptions
+from .http_session import (CircuitOpenError, DeadlineExceededError, conditional_headers, get_shared_session,
+                           response_validators)
+from .image_cache import get_shared_image_cache
+from .image_processing import sniff_image_format
+from .long_request import LongRequestPoller
+from .session_model import ResultStatus, SessionModel  # noqa: F401 ResultStatus is re-exported
+
 __all__ = ('ApplitoolsTestResultsHandler',)
 
 log = logging.getLogger('ApplitoolsTestResultsHandler')
 
-
-class ResultStatus(Enum):
-    PASSED = 'passed'
-    FAILED = 'failed'
-    NEW = 'new'
-    MISSING = 'missing'
+_session_url_pattern = re.compile(r'\/app\/batches\/(?P<batchId>\d+)\/(?P<sessionId>\d+)')
+_image_url_pattern = re.compile(r'\/api\/images\/(?P<imageId>[^/?]+)\/?$')
 
 
 class StatusCode(IntEnum):
     OK = 200
     CREATED = 201
     ACCEPTED = 202
+    NOT_MODIFIED = 304
     GONE = 410
 
 
 class ApplitoolsTestResultsHandler:
 
     def _get_session_id(self, test_results):
-        pattern = ('^' + re.escape(self.server_URL) +
-                   r'\/app\/batches\/\d+\/(?P<sessionId>\d+).*$')
-        return re.findall(pattern, test_results.url)[0]
+        return self.get_session_key(test_results)[1]
 
     def _get_batch_id(self, test_results):
-        pattern = ('^' + re.escape(self.server_URL) +
-                   r'\/app\/batches\/(?P<batchId>\d+).*$')
-        return re.findall(pattern, test_results.url)[0]
+        return self.get_session_key(test_results)[0]
 
-    def _get_server_url(self, test_results):
+    @staticmethod
+    def get_session_key(test_results):
+        """Return (batch_id, session_id) of the session `test_results` belong to"""
+        match = _session_url_pattern.search(test_results.url)
+        return match.group('batchId'), match.group('sessionId')
+
+    @staticmethod
+    def get_server_url(test_results):
         return test_results.url[0:test_results.url.find("/app/batches")]
 
-    def __init__(self, test_results, view_key):
+    def _get_server_url(self, test_results):
+        return self.get_server_url(test_results)
+
+    def __init__(self, test_results, view_key, *, http_session=None, image_cache=None, options=None,
+                 test_json=None):
         self.view_key = view_key
+        self.options = options if options is not None else TestResultsHandlerOptions()
+        self.http = http_session if http_session is not None else get_shared_session()
+        self.image_cache = image_cache if image_cache is not None else get_shared_image_cache()
         self.test_results = test_results
         self.server_URL = self._get_server_url(test_results)
-        self.session_ID = self._get_session_id(test_results)
-        self.batch_ID = self._get_batch_id(test_results)
-        self.test_JSON = self.get_test_json()
+        self.batch_ID, self.session_ID = self.get_session_key(test_results)
+        # test JSON preloaded together with other sessions is used as is,
+        # only its parsed model is kept
+        self.session = SessionModel(test_json if test_json is not None else self.get_test_json())
+        # milliseconds
         self.retry_request_interval = 500
         self.long_request_delay = 2
         self.default_timeout = 30
         self.reduced_timeout = 15
         self.counter = 0
+        # url -> seconds spent waiting on the long running server task
+        self.long_request_wait_times = {}
+
+    @property
+    def test_JSON(self):
+        """Raw session JSON, requested again as handlers keep only the parsed `session`"""
+        return self.get_test_json()
 
     def calculate_step_results(self):
-        expected = self.test_JSON['expectedAppOutput']
-        actual = self.test_JSON['actualAppOutput']
-        steps = max(len(expected), len(actual))
-        steps_result = list()
-        for i in range(steps):
-            if actual[i] is None:
-                steps_result.append(ResultStatus.MISSING)
-            elif expected[i] is None:
-                steps_result.append(ResultStatus.NEW)
-            elif actual[i]['isMatching']:
-                steps_result.append(ResultStatus.PASSED)
-            else:
-                steps_result.append(ResultStatus.FAILED)
-        return steps_result
+        return list(self.session.step_states)
 
     def download_diffs(self, path):
         path = self.prepare_path(path)
-        step_states = self.calculate_step_results()
-        for i in range(len(step_states)):
-            if step_states[i] is ResultStatus.FAILED:
+        for i in range(len(self.session)):
+            if self.session.is_failed(i):
                 image_url = self.server_URL + '/api/sessions/batches/' + self.batch_ID + '/' + self.session_ID + '/steps/' + str(
                     i + 1) + '/diff'
-                diff_path = path + "/diff_step_" + str(i + 1) + ".jpg"
-                self.image_from_url_to_file(url=image_url, path=diff_path)
+                diff_path = path + "/diff_step_" + str(i + 1)
+                self.image_from_url_to_file(url=image_url, path=diff_path + '.download')
+                self.add_image_extension(diff_path + '.download', diff_path)
             else:
                 print("No Diff image in step " + str(i + 1) + '\n')
 
     def image_names(self):
-        scenario_name = self.test_JSON['scenarioName']
-        image_names = []
-        for output in self.test_JSON['actualAppOutput']:
-            if output is None:
-                image_names.append(None)
-            else:
-                image_names.append(
-                    scenario_name + '_applitools_step_' + output['tag'])
-        return image_names
+        scenario_name = self.session.scenario_name
+        return [None if tag is None else scenario_name + '_applitools_step_' + tag
+                for tag in self.session.checkpoint_tags]
 
     def image_paths_and_names(self):
-        test_name = self.test_JSON['scenarioName']
-        screen = self.test_JSON['baselineEnv']['hostingApp']
-        image_names = []
-        for number, label in enumerate(self.test_JSON['actualAppOutput']):
-            image_names.append('step_{}_{}.png'.format(number, label['tag']))
-        return test_name, screen, image_names
+        image_names = ['step_{}_{}.png'.format(number, tag)
+                       for number, tag in enumerate(self.session.checkpoint_tags)]
+        return self.session.scenario_name, self.session.baseline_hosting_app, image_names
 
     def download_images(self, path):
         self.download_baseline_images(path=path)
@@ -113,9 +114,9 @@ class ApplitoolsTestResultsHandler:
         for i in range(self.test_results.steps):
             image_id = self.get_image_id("actualAppOutput", i)
             if image_id is not None:
-                image_url = self.server_URL + '/api/images/' + image_id
-                curr_path = path + "/current_step_" + str(i + 1) + ".jpg"
-                self.image_from_url_to_file(url=image_url, path=curr_path)
+                curr_path = path + "/current_step_" + str(i + 1)
+                self.image_from_id_to_file(image_id=image_id, path=curr_path + '.download')
+                self.add_image_extension(curr_path + '.download', curr_path)
 
     def download_baseline_images(self, path):
         path = self.prepare_path(path)
@@ -123,18 +124,86 @@ class ApplitoolsTestResultsHandler:
         for i in range(self.test_results.steps):
             image_id = self.get_image_id("expectedAppOutput", i)
             if image_id is not None:
-                image_url = self.server_URL + '/api/images/' + image_id
-                base_path = path + "/baseline_step_" + str(i + 1) + ".jpg"
-                self.image_from_url_to_file(url=image_url, path=base_path)
+                base_path = path + "/baseline_step_" + str(i + 1)
+                self.image_from_id_to_file(image_id=image_id, path=base_path + '.download')
+                self.add_image_extension(base_path + '.download', base_path)
 
-    def image_from_url_to_file(self, url, path):
-        with self.send_long_request('GET', url) as resp, \
-                open(path, 'wb') as out_file:
-            out_file.write(resp.content)
-            out_file.flush()
-            out_file.close()
+    @staticmethod
+    def add_image_extension(downloaded_path, path):
+        """Move downloaded image to `path` with extension of its actual format"""
+        with open(downloaded_path, 'rb') as f:
+            extension, _ = sniff_image_format(f.read(16))
+        file_path = path + '.' + extension
+        os.replace(downloaded_path, file_path)
+        return file_path
+
+    def image_from_id_to_file(self, image_id, path):
+        if self.image_cache is not None:
+            cached_path = self.image_cache.get_path(image_id)
+            if cached_path is not None:
+                shutil.copyfile(cached_path, path)
+                return
+        image_url = self.server_URL + '/api/images/' + image_id
+        self.image_from_url_to_file(url=image_url, path=path)
+        if self.image_cache is not None:
+            self.image_cache.put_file(image_id, path)
+
+    @staticmethod
+    def get_image_id_from_url(url):
+        """Return Eyes image id if `url` points to an image, None for diffs"""
+        match = _image_url_pattern.search(url)
+        return match.group('imageId') if match else None
+
+    def get_cached_image(self, url):
+        image_id = self.get_image_id_from_url(url)
+        if self.image_cache is None or image_id is None:
+            return None
+        return self.image_cache.get(image_id)
+
+    def get_revalidated_image(self, url):
+        """Return (content, validators) of a cached image without id (diff),
+        it can change on the server, so it is requested conditionally"""
+        if self.image_cache is None or self.get_image_id_from_url(url) is not None:
+            return None, {}
+        return self.image_cache.get_validated(url)
+
+    def cache_image(self, url, content, validators=None):
+        if self.image_cache is None:
+            return
+        image_id = self.get_image_id_from_url(url)
+        if image_id is not None:
+            self.image_cache.put(image_id, content)
+        elif validators:
+            self.image_cache.put_validated(url, content, validators)
+
+    def image_content_from_url(self, url):
+        content = self.get_cached_image(url)
+        if content is not None:
+            return content
+        cached_content, validators = self.get_revalidated_image(url)
+        with self.send_long_request('GET', url, conditional_headers(validators)) as resp:
+            if resp.status_code == StatusCode.NOT_MODIFIED:
+                return cached_content
             resp.raw.decode_content = True
-            shutil.copyfileobj(resp.raw, out_file)
+            content = resp.content
+            validators = response_validators(resp)
+        self.cache_image(url, content, validators)
+        return content
+
+    def image_from_url_to_file(self, url, path):
+        # stream into a temp file next to the target and rename it once complete,
+        # so an interrupted download never leaves a half-written image behind
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as out_file, \
+                    self.send_long_request('GET', url) as resp:
+                for chunk in resp.iter_content(chunk_size=self.options.download_chunk_size):
+                    out_file.write(chunk)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
 
     def prepare_path(self, path):
         path = path + "/" + self.batch_ID + "/" + self.session_ID
@@ -143,29 +212,54 @@ class ApplitoolsTestResultsHandler:
         return path
 
     def get_image_id(self, image_type, step):
-        try:
-            return self.test_JSON[image_type][step]['image']['id']
-        except TypeError:
-            if image_type == "actualAppOutput":
+        if image_type == "actualAppOutput":
+            image_id = self.session.checkpoint_image_id(step)
+            if image_id is None:
                 log.warning("The current image "
                             "in step {} is missing\n".format(step))
-            elif image_type == "expectedAppOutput":
+        elif image_type == "expectedAppOutput":
+            image_id = self.session.baseline_image_id(step)
+            if image_id is None:
                 log.warning("The baseline image "
                             "in step {} is missing\n".format(step))
-        return None
+        else:
+            image_id = None
+        return image_id
 
     def get_test_json(self):
-        request_url = (str(self.server_URL) + '/api/sessions/batches/' +
-                       str(self.batch_ID) + '/' + str(self.session_ID) +
-                       '/?apiKey=' + str(self.view_key) + '&format=json')
-        test_json = requests.get(request_url.encode('ascii', 'ignore')).json()
+        return self.request_test_json(self.http, self.server_URL, self.batch_ID, self.session_ID,
+                                      self.view_key, self.image_cache)
+
+    @staticmethod
+    def request_test_json(http_session, server_url, batch_id, session_id, view_key, image_cache=None):
+        session_url = (str(server_url) + '/api/sessions/batches/' +
+                       str(batch_id) + '/' + str(session_id) + '/')
+        request_url = session_url + '?apiKey=' + str(view_key) + '&format=json'
+        # session JSON cached by an earlier run is reused unless it has changed
+        cached_content, validators = (image_cache.get_validated(session_url)
+                                      if image_cache is not None else (None, {}))
+        response = http_session.get(request_url.encode('ascii', 'ignore'),
+                                    headers=conditional_headers(validators))
+        if response.status_code == StatusCode.NOT_MODIFIED and cached_content is not None:
+            test_json = json.loads(cached_content.decode('utf-8'))
+        else:
+            test_json = response.json()
+            validators = response_validators(response)
+            if image_cache is not None and validators:
+                image_cache.put_validated(session_url, response.content, validators)
         test_json = dict([(str(k), v) for k, v in test_json.items()])
         return test_json
 
-    def send_long_request(self, request_type, url):
+    def send_long_request(self, request_type, url, headers=None):
         request = self.create_request(request_type, url)
+        if headers:
+            request["headers"] = headers
+        poller = self.create_long_request_poller()
         response = self.send_request(request)
-        return self.long_request_check_status(response)
+        try:
+            return self.long_request_check_status(response, poller)
+        finally:
+            self.record_long_request_wait(url, poller)
 
     def create_request_headers(self, request_type, url, request=None):
         if request is None:
@@ -196,82 +290,94 @@ class ApplitoolsTestResultsHandler:
 
         try:
             if request_type == 'GET':
-                response = requests.get(
+                response = self.http.get(
                     url,
+                    headers=request.get("headers"),
                     stream=True
                 )
             elif request_type == 'POST':
-                response = requests.post(
+                response = self.http.post(
                     url,
+                    headers=request.get("headers"),
                     stream=True
                 )
             elif request_type == 'DELETE':
-                response = requests.delete(
+                response = self.http.delete(
                     url,
+                    headers=request.get("headers"),
                     stream=True
                 )
             else:
                 raise Exception("Not a valid request type")
             return response
 
+        except (CircuitOpenError, DeadlineExceededError):
+            raise
         except Exception as e:
             log.error("Error: {}".format(e))
-            if retry > 0:
+            # retries are shared by all requests, so an unreachable server
+            # doesn't get every single request retried
+            if retry > 0 and self.http.acquire_retry():
                 if delay_before_retry:
-                    time.sleep(self.retry_request_interval)
+                    time.sleep(self.retry_request_interval / 1000.0)
                     return self.send_request(request, retry - 1,
                                              delay_before_retry)
                 return self.send_request(request, retry - 1,
                                          delay_before_retry)
             raise Exception("Error: {}".format(e))
 
-    def long_request_check_status(self, response):
-        status = response.status_code
-
-        # OK
-        if status == StatusCode.OK:
-            return response
-
-        # Accepted
-        elif status == StatusCode.ACCEPTED:
-            url = response.headers.get("location")
-            request = self.create_request('GET', url)
-            request_response = self.long_request_loop(request,
-                                                      self.long_request_delay)
-            return self.long_request_check_status(request_response)
-
-        # Created
-        # The request has been fulfilled and has resulted in
-        # one or more new resources being created
-        elif status == StatusCode.CREATED:
-            url = response.headers.get("location")
-            request = self.create_request('DELETE', url)
-            return self.send_request(request)
-
-        # Gone
-        # The target resource is no longer available
-        elif status == StatusCode.GONE:
-            raise Exception("The server task has gone")
-        else:
-            raise Exception("Unknown error during long request: {}".format(
-                response.status_code))
-
-    @staticmethod
-    def _increment_delay(delay):
-        return min(10, floor(delay * 1.5))
-
-    @staticmethod
-    def should_retry(response):
-        status_code = response.status_code
-        return status_code is StatusCode.ACCEPTED
-
-    def long_request_loop(self, request, delay):
-        delay = self._increment_delay(delay)
-        log.info("The request has been accepted, but not completed.\n"
-                 "Retrying in {} s".format(delay))
-        time.sleep(delay)
-
-        response = self.send_request(request)
-        if self.should_retry(response):
-            return self.long_request_loop(request, delay)
-        return response
+    def create_long_request_poller(self):
+        return LongRequestPoller(
+            self.long_request_delay,
+            max_delay=self.options.long_request_max_delay,
+            timeout=self.options.long_request_timeout,
+            deadline=getattr(self.http, 'deadline', None))
+
+    def record_long_request_wait(self, url, poller):
+        if poller.polls:
+            self.long_request_wait_times[url] = (
+                self.long_request_wait_times.get(url, 0) + poller.waited)
+
+    def long_request_check_status(self, response, poller=None):
+        if poller is None:
+            poller = self.create_long_request_poller()
+        poll_url = None
+        while True:
+            status = response.status_code
+
+            # OK, or Not Modified for conditional requests
+            if status == StatusCode.OK or status == StatusCode.NOT_MODIFIED:
+                return response
+
+            # Accepted
+            # Poll the task location (or the same url when the server
+            # doesn't send a new one) until it is not accepted anymore
+            elif status == StatusCode.ACCEPTED:
+                url = response.headers.get("location") or poll_url
+                if url is None:
+                    raise Exception("Accepted long request has no location")
+                delay = poller.next_delay(response)
+                # release the pooled connection before polling
+                response.close()
+                log.info("The request has been accepted, but not completed.\n"
+                         "Retrying in {:.1f} s".format(delay))
+                time.sleep(delay)
+                poll_url = url
+                response = self.send_request(self.create_request('GET', url))
+
+            # Created
+            # The request has been fulfilled and has resulted in
+            # one or more new resources being created
+            elif status == StatusCode.CREATED:
+                url = response.headers.get("location")
+                response.close()
+                request = self.create_request('DELETE', url)
+                return self.send_request(request)
+
+            # Gone
+            # The target resource is no longer available
+            elif status == StatusCode.GONE:
+                raise Exception("The server task has gone")
+            else:
+                raise Exception("Unknown error during long request: {}".format(
+                    response.status_code))
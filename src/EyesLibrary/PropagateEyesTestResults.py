@@ -1,17 +1,30 @@
+import sqlite3
+
 from robot.api import SuiteVisitor
 from robot.api import logger as robot_logger
 from robot.model import TestSuite
 
-from EyesLibrary.test_results_manager import SuitePostProcessManager
+from EyesLibrary.test_results_manager import SuitePostProcessManager, SuiteResultsCache
 
 
 class PropagateEyesTestResults(SuiteVisitor):
     """Post-propagate eyes test results to robot report. The original `output.xml` file
     won't change, only `report.html` and `logs.html` are affected."""
 
+    def __init__(self):
+        # results file is parsed once for all suites of the tree
+        self.results_cache = SuiteResultsCache()
+        # results path -> suite that loaded it, the file is released at its end
+        self.results_owners = {}  # type: dict[str, TestSuite]
+
     def start_suite(self, suite):
         # type: (TestSuite) -> None
-        manager = SuitePostProcessManager(suite)
+        manager = SuitePostProcessManager(suite, self.results_cache)
+        path_to_test_results = manager.get_results_path(suite)
+        if path_to_test_results is not None and not self.results_cache.is_loaded(
+            path_to_test_results
+        ):
+            self.results_owners.setdefault(path_to_test_results, suite)
 
         try:
             manager.import_suite_data()
@@ -20,4 +33,22 @@ class PropagateEyesTestResults(SuiteVisitor):
                 "Failed to post-process suite: {} with error: {}".format(suite.name, e)
             )
             return
-        manager.process_suite()
+        except (OSError, ValueError, sqlite3.Error) as e:
+            robot_logger.warn(
+                "Failed to read Eyes results of suite: {} with error: {}".format(suite.name, e)
+            )
+            return
+        # shards are read while the suite is processed
+        try:
+            manager.process_suite()
+        except (OSError, ValueError, sqlite3.Error) as e:
+            robot_logger.warn(
+                "Failed to read Eyes results of suite: {} with error: {}".format(suite.name, e)
+            )
+
+    def end_suite(self, suite):
+        # type: (TestSuite) -> None
+        path_to_test_results = SuitePostProcessManager.get_results_path(suite)
+        if self.results_owners.get(path_to_test_results) is suite:
+            del self.results_owners[path_to_test_results]
+            self.results_cache.release(path_to_test_results)
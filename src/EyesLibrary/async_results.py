@@ -0,0 +1,344 @@
+from __future__ import absolute_import, unicode_literals
+
+import asyncio
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Callable, Iterable, Optional, Text
+
+from .ApplitoolsBase64TestResultHandler import ApplitoolsBase64TestResultHandler
+from .ApplitoolsTestResultHandler import StatusCode
+from .http_session import conditional_headers, response_validators
+
+if TYPE_CHECKING:
+    import requests
+
+    from applitools.common import TestResults
+
+    from .config import TestResultsHandlerOptions
+    from .http_session import ResultsHttpSession
+    from .image_downloader import ImageDownloader
+    from .long_request import LongRequestPoller
+
+__all__ = ("AsyncResultsRetriever",)
+
+log = logging.getLogger("AsyncResultsRetriever")
+
+
+class _TestReleased(Exception):
+    """The test was rendered before its images were retrieved"""
+
+
+class _Turn(object):
+    """Permission of a test to download and hold its images, granted to
+    `window` tests at a time in the order they are rendered"""
+
+    def __init__(self):
+        self.event = asyncio.Event()
+        self.released = False
+
+    async def wait(self):
+        await self.event.wait()
+        if self.released:
+            raise _TestReleased()
+
+
+class AsyncResultsRetriever(object):
+    """Retrieves test JSON and images of many sessions under one event loop.
+
+    The loop runs on a background thread for the whole close phase.
+    Blocking HTTP calls run on a bounded executor, while waiting between
+    polls of long running server tasks is done with `asyncio.sleep`, so
+    sessions waiting on the server don't hold a worker thread and all of
+    them wait concurrently. Images are only downloaded by `window` tests
+    ahead of rendering and are handed over to `ImageDownloader`, where the
+    synchronous html rendering picks them up.
+    """
+
+    def __init__(
+        self,
+        view_key,
+        http_session,
+        downloader,
+        options,
+        session_handlers=None,
+        test_json=None,
+    ):
+        # type: (Text, ResultsHttpSession, ImageDownloader, TestResultsHandlerOptions, Optional[dict], Optional[dict]) -> None
+        self.view_key = view_key
+        # preloaded {session key: test JSON}, sessions missing here are fetched
+        self.test_json = {} if test_json is None else test_json
+        self.http = http_session
+        self.downloader = downloader
+        self.options = options
+        # handlers are shared with the caller to not fetch test JSON twice
+        self.session_handlers = {} if session_handlers is None else session_handlers
+        self.window = options.prefetch_window
+        self._loop = None  # type: Optional[asyncio.AbstractEventLoop]
+        self._executor = None  # type: Optional[ThreadPoolExecutor]
+        self._thread = None  # type: Optional[threading.Thread]
+        self._task = None  # type: Optional[asyncio.Future]
+        self._lock = threading.Lock()
+        # user test id -> set once its images are retrieved (or failed)
+        self._done = {}  # type: dict[Text, threading.Event]
+        # owned by the loop thread
+        self._turns = {}  # type: dict[Text, _Turn]
+        self._unreleased = []  # type: list[Text]
+
+    def start(self, tests):
+        # type: (Iterable[tuple[Text, list[TestResults]]]) -> None
+        """Start retrieving (user test id, its test results) in rendering order"""
+        tests = list(tests)
+        self._done = dict((user_test_id, threading.Event()) for user_test_id, _ in tests)
+        self._loop = asyncio.new_event_loop()
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.options.max_workers, thread_name_prefix="EyesAsyncResults"
+        )
+        self._loop.set_default_executor(self._executor)
+        self._thread = threading.Thread(
+            target=self._run, args=(tests,), name="EyesAsyncResultsLoop"
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, tests):
+        # type: (list[tuple[Text, list[TestResults]]]) -> None
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._turns = dict((user_test_id, _Turn()) for user_test_id, _ in tests)
+            self._unreleased = [user_test_id for user_test_id, _ in tests]
+            self._grant_turns()
+            self._task = asyncio.ensure_future(self._prefetch_all(tests))
+            self._loop.run_until_complete(self._task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            with self._lock:
+                self._loop.close()
+            for done in self._done.values():
+                done.set()
+
+    def _call_soon(self, callback, *args):
+        # type: (Callable, *Any) -> None
+        """Run `callback` on the loop thread, nothing to do once the loop is closed"""
+        with self._lock:
+            if self._loop is not None and not self._loop.is_closed():
+                self._loop.call_soon_threadsafe(callback, *args)
+
+    def _grant_turns(self):
+        # type: () -> None
+        for user_test_id in self._unreleased[: self.window]:
+            self._turns[user_test_id].event.set()
+
+    def _grant_turn(self, user_test_id):
+        # type: (Text) -> None
+        turn = self._turns.get(user_test_id)
+        if turn is not None:
+            turn.event.set()
+
+    def _release(self, user_test_id):
+        # type: (Text) -> None
+        turn = self._turns.get(user_test_id)
+        if turn is None or turn.released:
+            return
+        turn.released = True
+        turn.event.set()
+        self._unreleased.remove(user_test_id)
+        self._grant_turns()
+
+    def wait(self, user_test_id):
+        # type: (Text) -> None
+        """Block until images of the test are retrieved, the test gets its
+        turn even if rendered out of order"""
+        done = self._done.get(user_test_id)
+        if done is None:
+            return
+        self._call_soon(self._grant_turn, user_test_id)
+        done.wait()
+
+    def release(self, user_test_id):
+        # type: (Text) -> None
+        """The test is rendered, let the next test download its images"""
+        self._call_soon(self._release, user_test_id)
+
+    def close(self):
+        # type: () -> None
+        """Stop retrieving images of tests that weren't rendered"""
+        if self._thread is None:
+            return
+        self._call_soon(self._cancel)
+        self._thread.join()
+        self._executor.shutdown(wait=True)
+        self._thread = None
+
+    def _cancel(self):
+        # type: () -> None
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run_blocking(self, func, *args):
+        # type: (Callable, *Any) -> Any
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, functools.partial(func, *args))
+
+    async def _prefetch_all(self, tests):
+        await asyncio.gather(
+            *(
+                self._prefetch_user_test(user_test_id, test_results_list)
+                for user_test_id, test_results_list in tests
+            )
+        )
+
+    async def _prefetch_user_test(self, user_test_id, test_results_list):
+        # type: (Text, list[TestResults]) -> None
+        try:
+            await asyncio.gather(
+                *(
+                    self._prefetch_test(test_results, self._turns[user_test_id])
+                    for test_results in test_results_list
+                )
+            )
+        finally:
+            self._done[user_test_id].set()
+
+    async def get_handler(self, test_results, turn=None):
+        # type: (TestResults, Optional[_Turn]) -> ApplitoolsBase64TestResultHandler
+        session_key = ApplitoolsBase64TestResultHandler.get_session_key(test_results)
+        handler = self.session_handlers.get(session_key)
+        if handler is None:
+            # handler fetches test JSON in constructor
+            handler = await self._run_blocking(
+                functools.partial(
+                    ApplitoolsBase64TestResultHandler,
+                    test_results,
+                    self.view_key,
+                    http_session=self.http,
+                    downloader=self.downloader,
+                    options=self.options,
+                    test_json=self.test_json.pop(session_key, None),
+                )
+            )
+            if turn is not None and turn.released:
+                # the test is written already, its handler must not be held
+                raise _TestReleased()
+            self.session_handlers[session_key] = handler
+        return handler
+
+    async def _prefetch_test(self, test_results, turn):
+        # type: (TestResults, _Turn) -> None
+        try:
+            await self._prefetch_test_images(test_results, turn)
+        except _TestReleased:
+            pass
+        except Exception as e:
+            # images left behind are downloaded again during html rendering
+            log.warning("Failed to prefetch images of {}: {}".format(test_results, e))
+
+    async def _prefetch_test_images(self, test_results, turn):
+        # type: (TestResults, _Turn) -> None
+        handler = await self.get_handler(test_results, turn)
+        image_urls = []
+        for image_url_dict in handler.get_step_image_url_list():
+            for image_kind in handler._image_kinds:
+                image_url = image_url_dict[image_kind]
+                # images harvested during the run are submitted already
+                if image_url is not None and not self.downloader.is_pending(image_url):
+                    image_urls.append(image_url)
+        await asyncio.gather(
+            *(self._prefetch_image(handler, image_url, turn) for image_url in image_urls)
+        )
+
+    async def _prefetch_image(self, handler, url, turn):
+        # type: (ApplitoolsBase64TestResultHandler, Text, _Turn) -> None
+        if handler.use_report_assets() and handler.report_assets.get_alias(url):
+            image = await self._run_blocking(handler.image_from_url_to_asset, url)
+            self.downloader.put(url, image)
+            return
+        if handler.get_image_id_from_url(url) is not None or handler.image_cache is not None:
+            # no server task to wait for, or its result may be read from the cache
+            await turn.wait()
+        content = await self._run_blocking(handler.get_cached_image, url)
+        if content is None:
+            cached_content, validators = await self._run_blocking(
+                handler.get_revalidated_image, url
+            )
+            resp = await self.send_long_request(
+                handler, "GET", url, conditional_headers(validators), turn
+            )
+            try:
+                if resp.status_code == StatusCode.NOT_MODIFIED:
+                    content = cached_content
+                else:
+                    content = await self._run_blocking(lambda: resp.content)
+                    validators = response_validators(resp)
+            finally:
+                resp.close()
+            await self._run_blocking(handler.cache_image, url, content, validators)
+        image = await self._run_blocking(handler.content_to_report_image, url, content)
+        self.downloader.put(url, image)
+
+    async def send_long_request(self, handler, request_type, url, headers=None, turn=None):
+        # type: (ApplitoolsBase64TestResultHandler, Text, Text, Optional[dict], Optional[_Turn]) -> requests.Response
+        request = handler.create_request(request_type, url)
+        if headers:
+            request["headers"] = headers
+        poller = handler.create_long_request_poller()
+        response = await self._run_blocking(handler.send_request, request)
+        try:
+            return await self.long_request_check_status(
+                handler, response, poller, request, turn
+            )
+        finally:
+            handler.record_long_request_wait(url, poller)
+
+    async def long_request_check_status(self, handler, response, poller, request=None, turn=None):
+        # type: (ApplitoolsBase64TestResultHandler, requests.Response, LongRequestPoller, Optional[dict], Optional[_Turn]) -> requests.Response
+        """Coroutine counterpart of `long_request_check_status` of the handler.
+
+        The server task is polled right away, its result is downloaded
+        only once the test has its `turn`."""
+        poll_url = None
+        while True:
+            status = response.status_code
+            if (
+                status == StatusCode.OK
+                and poll_url is None
+                and turn is not None
+                and not turn.event.is_set()
+            ):
+                response.close()
+                await turn.wait()
+                # finished at once, requested again when the test has its turn
+                response = await self._run_blocking(handler.send_request, request)
+                turn = None
+                continue
+            if status == StatusCode.OK or status == StatusCode.NOT_MODIFIED:
+                return response
+            elif status == StatusCode.ACCEPTED:
+                url = response.headers.get("location") or poll_url
+                if url is None:
+                    raise Exception("Accepted long request has no location")
+                delay = poller.next_delay(response)
+                response.close()
+                log.info(
+                    "The request has been accepted, but not completed.\n"
+                    "Retrying in {:.1f} s".format(delay)
+                )
+                await asyncio.sleep(delay)
+                poll_url = url
+                request = handler.create_request("GET", url)
+                response = await self._run_blocking(handler.send_request, request)
+            elif status == StatusCode.CREATED:
+                url = response.headers.get("location")
+                response.close()
+                if turn is not None:
+                    await turn.wait()
+                request = handler.create_request("DELETE", url)
+                return await self._run_blocking(handler.send_request, request)
+            elif status == StatusCode.GONE:
+                raise Exception("The server task has gone")
+            else:
+                raise Exception(
+                    "Unknown error during long request: {}".format(status)
+                )
@@ -1,4 +1,5 @@
-from typing import Optional
+from enum import Enum
+from typing import Optional, Text
 
 import attr
 
@@ -6,7 +7,73 @@ from applitools.common.selenium import Configuration
 from applitools.selenium import RunnerOptions
 
 
+class TestResultsBackend(Enum):
+    sync = "sync"
+    asyncio = "asyncio"
+
+
+class ReportImageStorage(Enum):
+    inline = "inline"
+    assets = "assets"
+
+
+class ReportImages(Enum):
+    none = "none"
+    failed_only = "failed_only"
+    diffs_only = "diffs_only"
+    all = "all"
+
+
+class ResultsFormat(Enum):
+    jsonl = "jsonl"
+    sqlite = "sqlite"
+
+
+class ThumbnailFormat(Enum):
+    JPEG = "JPEG"
+    WEBP = "WEBP"
+
+
+@attr.s
+class TestResultsHandlerOptions(object):
+    """Options of the handlers that download Eyes test results at suite close."""
+
+    pool_connections = attr.ib(default=10)  # type: int
+    pool_maxsize = attr.ib(default=10)  # type: int
+    keep_alive = attr.ib(default=True)  # type: bool
+    request_timeout = attr.ib(default=30)  # type: int
+    retry_budget = attr.ib(default=20)  # type: int
+    circuit_breaker_threshold = attr.ib(default=5)  # type: int
+    circuit_breaker_reset_timeout = attr.ib(default=30)  # type: int
+    max_workers = attr.ib(default=8)  # type: int
+    prefetch_window = attr.ib(default=4)  # type: int
+    backend = attr.ib(default=TestResultsBackend.sync)  # type: TestResultsBackend
+    harvest_results_on_test_end = attr.ib(default=False)  # type: bool
+    image_cache_dir = attr.ib(default=None)  # type: Optional[Text]
+    image_cache_max_size = attr.ib(default=1024)  # type: int
+    download_chunk_size = attr.ib(default=64 * 1024)  # type: int
+    report_image_storage = attr.ib(
+        default=ReportImageStorage.inline
+    )  # type: ReportImageStorage
+    report_images = attr.ib(default=ReportImages.all)  # type: ReportImages
+    report_assets_dir = attr.ib(default="eyes_assets")  # type: Text
+    thumbnail_max_size = attr.ib(default=None)  # type: Optional[int]
+    thumbnail_format = attr.ib(default=ThumbnailFormat.JPEG)  # type: ThumbnailFormat
+    thumbnail_quality = attr.ib(default=75)  # type: int
+    report_image_format = attr.ib(default=None)  # type: Optional[ThumbnailFormat]
+    report_image_quality = attr.ib(default=85)  # type: int
+    image_encoding_workers = attr.ib(default=None)  # type: Optional[int]
+    long_request_max_delay = attr.ib(default=10)  # type: int
+    long_request_timeout = attr.ib(default=300)  # type: Optional[int]
+    results_retrieval_timeout = attr.ib(default=None)  # type: Optional[int]
+    results_format = attr.ib(default=ResultsFormat.jsonl)  # type: ResultsFormat
+    results_dir = attr.ib(default=None)  # type: Optional[Text]
+
+
 @attr.s
 class RobotConfiguration(Configuration):
     runner_options = attr.ib(default=None)  # type: Optional[RunnerOptions]
     propagate_eyes_test_results = attr.ib(default=True)
+    test_results_handler = attr.ib(
+        factory=TestResultsHandlerOptions
+    )  # type: TestResultsHandlerOptions
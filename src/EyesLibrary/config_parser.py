@@ -27,7 +27,15 @@ from applitools.common import (
 from applitools.common.selenium import BrowserType
 from applitools.selenium import BatchInfo, RunnerOptions
 
-from .config import RobotConfiguration
+from .config import (
+    ReportImages,
+    ReportImageStorage,
+    ResultsFormat,
+    RobotConfiguration,
+    TestResultsBackend,
+    TestResultsHandlerOptions,
+    ThumbnailFormat,
+)
 from .errors import EyesLibraryConfigError, EyesLibraryValueError
 from .utils import (
     get_enum_by_name,
@@ -223,6 +231,57 @@ class ProxyTrafaret(trf.Trafaret):
         return ProxySettings(host_or_url=sanitized.pop("host_or_url"), **sanitized)
 
 
+class TestResultsHandlerTrafaret(trf.Trafaret):
+    scheme = trf.Dict(
+        {
+            trf.Key("pool_connections", optional=True): trf.Int(gte=1),
+            trf.Key("pool_maxsize", optional=True): trf.Int(gte=1),
+            trf.Key("keep_alive", optional=True): trf.Bool,
+            trf.Key("request_timeout", optional=True): trf.Int(gte=1),
+            trf.Key("retry_budget", optional=True): trf.Int(gte=0),
+            trf.Key("circuit_breaker_threshold", optional=True): trf.Int(gte=1),
+            trf.Key("circuit_breaker_reset_timeout", optional=True): trf.Int(gte=1),
+            trf.Key("max_workers", optional=True): trf.Int(gte=1),
+            trf.Key("prefetch_window", optional=True): trf.Int(gte=1),
+            trf.Key("backend", optional=True): TextToEnumTrafaret(
+                TestResultsBackend
+            ),
+            trf.Key("harvest_results_on_test_end", optional=True): trf.Bool,
+            trf.Key("image_cache_dir", optional=True): trf.String,
+            trf.Key("image_cache_max_size", optional=True): trf.Int(gte=1),
+            trf.Key("download_chunk_size", optional=True): trf.Int(gte=1),
+            trf.Key("report_image_storage", optional=True): TextToEnumTrafaret(
+                ReportImageStorage
+            ),
+            trf.Key("report_images", optional=True): TextToEnumTrafaret(
+                ReportImages
+            ),
+            trf.Key("report_assets_dir", optional=True): trf.String,
+            trf.Key("thumbnail_max_size", optional=True): trf.Int(gte=1),
+            trf.Key("thumbnail_format", optional=True): UpperTextToEnumTrafaret(
+                ThumbnailFormat
+            ),
+            trf.Key("thumbnail_quality", optional=True): trf.Int(gte=1, lte=100),
+            trf.Key("report_image_format", optional=True): UpperTextToEnumTrafaret(
+                ThumbnailFormat
+            ),
+            trf.Key("report_image_quality", optional=True): trf.Int(gte=1, lte=100),
+            trf.Key("image_encoding_workers", optional=True): trf.Int(gte=0),
+            trf.Key("long_request_max_delay", optional=True): trf.Int(gte=1),
+            trf.Key("long_request_timeout", optional=True): trf.Int(gte=1),
+            trf.Key("results_retrieval_timeout", optional=True): trf.Int(gte=1),
+            trf.Key("results_format", optional=True): TextToEnumTrafaret(
+                ResultsFormat
+            ),
+            trf.Key("results_dir", optional=True): trf.String,
+        }
+    )
+
+    def check_and_return(self, value, context=None):
+        sanitized = self.scheme.check(value, context)
+        return TestResultsHandlerOptions(**sanitized)
+
+
 class BrowsersTrafaret(trf.Trafaret):
     scheme = trf.Dict(
         {
@@ -279,6 +338,9 @@ class ConfigurationTrafaret(trf.Trafaret):  # typedef
             ),
             trf.Key("wait_before_capture", optional=True): trf.Int,
             trf.Key("propagate_eyes_test_results", optional=True): trf.Bool,
+            trf.Key(
+                "test_results_handler", optional=True
+            ): TestResultsHandlerTrafaret,
         },
     )
     web_scheme = shared_scheme + trf.Dict(
@@ -0,0 +1,335 @@
+from __future__ import absolute_import, unicode_literals
+
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Optional, Text
+
+import requests
+from requests.adapters import HTTPAdapter
+
+if TYPE_CHECKING:
+    from EyesLibrary.config import TestResultsHandlerOptions
+
+__all__ = (
+    "CircuitBreaker",
+    "CircuitOpenError",
+    "DeadlineExceededError",
+    "ResultsHttpSession",
+    "RetryBudget",
+    "conditional_headers",
+    "response_validators",
+    "get_shared_session",
+    "close_shared_session",
+)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class DeadlineExceededError(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    """Fails requests fast after `failure_threshold` consecutive failures.
+
+    After `reset_timeout` seconds one trial request is let through
+    (half open state), its success closes the circuit again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        # type: (int, float) -> None
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.times_opened = 0
+        self.rejected = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        # type: () -> bool
+        """Whether requests are rejected, i.e. the trial request isn't due yet"""
+        with self._lock:
+            return (
+                self.state == self.OPEN
+                and time.monotonic() - self._opened_at < self.reset_timeout
+            )
+
+    def before_request(self):
+        # type: () -> None
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if (
+                self.state == self.OPEN
+                and time.monotonic() - self._opened_at >= self.reset_timeout
+            ):
+                self.state = self.HALF_OPEN
+                return
+            self.rejected += 1
+        raise CircuitOpenError(
+            "Eyes server requests are suspended after {} failures".format(
+                self.failures
+            )
+        )
+
+    def record_success(self):
+        # type: () -> None
+        with self._lock:
+            if self.state == self.OPEN:
+                # response of a request sent before the circuit opened
+                return
+            self.failures = 0
+            self.state = self.CLOSED
+
+    def record_failure(self):
+        # type: () -> None
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (
+                self.state == self.CLOSED and self.failures >= self.failure_threshold
+            ):
+                self.state = self.OPEN
+                self.times_opened += 1
+                self._opened_at = time.monotonic()
+
+    def reset(self):
+        # type: () -> None
+        """Close the circuit, counters of opened circuits and rejected requests are kept"""
+        with self._lock:
+            self.failures = 0
+            self.state = self.CLOSED
+
+
+class RetryBudget(object):
+    """Number of retries shared by all requests of the session, so a failing
+    server doesn't get every request retried."""
+
+    def __init__(self, max_retries=20):
+        # type: (int) -> None
+        self.max_retries = max_retries
+        self.used = 0
+        self.denied = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        # type: () -> bool
+        with self._lock:
+            if self.used >= self.max_retries:
+                self.denied += 1
+                return False
+            self.used += 1
+            return True
+
+    def reset(self):
+        # type: () -> None
+        with self._lock:
+            self.used = 0
+
+
+class ResultsHttpSession(object):
+    """Pooled keep-alive HTTP session shared by the test results handlers.
+
+    Counts the requests it sends so the connection reuse ratio
+    can be reported at suite close. `deadline` (`time.monotonic()` based)
+    limits all requests and waiting on long running server tasks of all
+    handlers using it, no request is sent once it's passed.
+    Connection errors and server errors trip the circuit `breaker`, retries
+    of all handlers are drawn from one `retry_budget`.
+    """
+
+    def __init__(
+        self,
+        pool_connections=10,
+        pool_maxsize=10,
+        keep_alive=True,
+        deadline=None,
+        timeout=30,
+        breaker=None,
+        retry_budget=None,
+    ):
+        # type: (int, int, bool, Optional[float], Optional[float], Optional[CircuitBreaker], Optional[RetryBudget]) -> None
+        self.deadline = deadline
+        self.timeout = timeout
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.retry_budget = retry_budget if retry_budget is not None else RetryBudget()
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.keep_alive = keep_alive
+        self.requests_sent = 0
+        self._lock = threading.Lock()
+        self._session = requests.Session()
+        self._adapter = HTTPAdapter(
+            pool_connections=pool_connections, pool_maxsize=pool_maxsize
+        )
+        self._session.mount("http://", self._adapter)
+        self._session.mount("https://", self._adapter)
+        if not keep_alive:
+            self._session.headers["Connection"] = "close"
+
+    @staticmethod
+    def _deadline(results_retrieval_timeout):
+        # type: (Optional[float]) -> Optional[float]
+        if not results_retrieval_timeout:
+            return None
+        return time.monotonic() + results_retrieval_timeout
+
+    @classmethod
+    def from_options(cls, options):
+        # type: (TestResultsHandlerOptions) -> ResultsHttpSession
+        deadline = cls._deadline(options.results_retrieval_timeout)
+        return cls(
+            pool_connections=options.pool_connections,
+            pool_maxsize=options.pool_maxsize,
+            keep_alive=options.keep_alive,
+            deadline=deadline,
+            timeout=options.request_timeout,
+            breaker=CircuitBreaker(
+                options.circuit_breaker_threshold, options.circuit_breaker_reset_timeout
+            ),
+            retry_budget=RetryBudget(options.retry_budget),
+        )
+
+    def reset_deadline(self, results_retrieval_timeout):
+        # type: (Optional[float]) -> None
+        """Start the `deadline`, circuit `breaker` and `retry_budget` over, so
+        a session created when results were harvested during the run gives
+        the listener close phase the whole time limit and retries"""
+        self.deadline = self._deadline(results_retrieval_timeout)
+        self.breaker.reset()
+        self.retry_budget.reset()
+
+    @property
+    def deadline_passed(self):
+        # type: () -> bool
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def request(self, method, url, **kwargs):
+        # type: (Text, Text, **Any) -> requests.Response
+        timeout = self.timeout
+        if self.deadline is not None:
+            remaining = self.deadline - time.monotonic()
+            if remaining <= 0:
+                raise DeadlineExceededError(
+                    # query of the url carries the api key
+                    "Eyes results retrieval timeout has passed, {} {} is not sent".format(
+                        method, url.split("?", 1)[0]
+                    )
+                )
+            if timeout is None or remaining < timeout:
+                timeout = remaining
+        self.breaker.before_request()
+        kwargs.setdefault("timeout", timeout)
+        with self._lock:
+            self.requests_sent += 1
+        try:
+            response = self._session.request(method, url, **kwargs)
+        except requests.RequestException:
+            self.breaker.record_failure()
+            raise
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+    def acquire_retry(self):
+        # type: () -> bool
+        """Whether a failed request may be retried, fails fast if circuit is open."""
+        return self.breaker.state == CircuitBreaker.CLOSED and self.retry_budget.acquire()
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+    def connection_stats(self):
+        # type: () -> dict
+        """Return number of sent requests, opened and reused connections."""
+        pools = self._adapter.poolmanager.pools
+        opened = 0
+        served = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            opened += pool.num_connections
+            served += pool.num_requests
+        return dict(
+            requests=self.requests_sent,
+            connections_opened=opened,
+            connections_reused=max(0, served - opened),
+            retries=self.retry_budget.used,
+            retries_denied=self.retry_budget.denied,
+            circuit_state=self.breaker.state,
+            circuit_opened=self.breaker.times_opened,
+            requests_rejected=self.breaker.rejected,
+        )
+
+    def close(self):
+        # type: () -> None
+        self._session.close()
+
+
+def response_validators(response):
+    # type: (requests.Response) -> dict
+    """Return validators of the response to be stored with its content."""
+    validators = {}
+    if response.headers.get("ETag"):
+        validators["etag"] = response.headers["ETag"]
+    if response.headers.get("Last-Modified"):
+        validators["last_modified"] = response.headers["Last-Modified"]
+    return validators
+
+
+def conditional_headers(validators):
+    # type: (dict) -> dict
+    """Return headers making request answered by 304 if content is unchanged."""
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
+
+_shared_session = None  # type: Optional[ResultsHttpSession]
+_shared_session_lock = threading.Lock()
+
+
+def get_shared_session(options=None):
+    # type: (Optional[TestResultsHandlerOptions]) -> ResultsHttpSession
+    """Return the process wide session, creating it from `options` if needed."""
+    global _shared_session
+    with _shared_session_lock:
+        if _shared_session is None:
+            if options is None:
+                _shared_session = ResultsHttpSession()
+            else:
+                _shared_session = ResultsHttpSession.from_options(options)
+        return _shared_session
+
+
+def close_shared_session():
+    # type: () -> Optional[dict]
+    """Close the process wide session and return its final connection stats."""
+    global _shared_session
+    with _shared_session_lock:
+        if _shared_session is None:
+            return None
+        stats = _shared_session.connection_stats()
+        _shared_session.close()
+        _shared_session = None
+        return stats
@@ -0,0 +1,206 @@
+from __future__ import absolute_import, unicode_literals
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from typing import TYPE_CHECKING, Optional, Text
+
+if TYPE_CHECKING:
+    from EyesLibrary.config import TestResultsHandlerOptions
+
+__all__ = ("ImageCache", "get_shared_image_cache", "close_shared_image_cache")
+
+log = logging.getLogger("ImageCache")
+
+MEGABYTE = 1024 * 1024
+# eviction frees space down to this part of `max_size`, so a full cache
+# is not walked again on every put
+LOW_WATER_RATIO = 0.9
+
+
+class ImageCache(object):
+    """Persistent on-disk cache of Eyes images keyed by image id.
+
+    Eyes image ids identify image content, so a cached image never becomes
+    stale. Files are written atomically (temp file + rename) and the least
+    recently used ones are evicted once the cache grows over `max_size` bytes.
+
+    Resources that can change (session JSON, diff images) are stored with
+    their HTTP validators by `put_validated` and must be revalidated
+    with the server before use.
+    """
+
+    def __init__(self, directory, max_size=1024 * MEGABYTE):
+        # type: (Text, int) -> None
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._size = None  # type: Optional[int]
+        self._lock = threading.Lock()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def path(self, image_id):
+        # type: (Text) -> Text
+        digest = hashlib.sha1(image_id.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def get_path(self, image_id):
+        # type: (Text) -> Optional[Text]
+        """Return path of cached image or None, marks image as recently used."""
+        path = self.path(image_id)
+        try:
+            os.utime(path, None)
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def get(self, image_id):
+        # type: (Text) -> Optional[bytes]
+        path = self.get_path(image_id)
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except (IOError, OSError):
+            # evicted by other process in between
+            return None
+
+    def put(self, image_id, content):
+        # type: (Text, bytes) -> None
+        path = self.path(image_id)
+        tmp_path = self._make_temp_file(path)
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        self._commit(tmp_path, path, len(content))
+
+    def put_file(self, image_id, source_path):
+        # type: (Text, Text) -> None
+        """Copy already downloaded image into the cache."""
+        path = self.path(image_id)
+        tmp_path = self._make_temp_file(path)
+        shutil.copyfile(source_path, tmp_path)
+        self._commit(tmp_path, path, os.path.getsize(tmp_path))
+
+    def get_validated(self, key):
+        # type: (Text) -> tuple[Optional[bytes], dict]
+        """Return content stored by `put_validated` and its HTTP validators."""
+        content = self.get(key)
+        if content is None:
+            return None, {}
+        try:
+            with open(self.path(key) + ".meta") as f:
+                return content, json.load(f)
+        except (IOError, OSError, ValueError):
+            return None, {}
+
+    def put_validated(self, key, content, validators):
+        # type: (Text, bytes, dict) -> None
+        path = self.path(key)
+        tmp_path = self._make_temp_file(path)
+        with open(tmp_path, "w") as f:
+            json.dump(validators, f)
+        with self._lock:
+            self._replace(tmp_path, path + ".meta", os.path.getsize(tmp_path))
+        self.put(key, content)
+
+    def _make_temp_file(self, path):
+        # type: (Text) -> Text
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        os.close(fd)
+        return tmp_path
+
+    def _commit(self, tmp_path, path, size):
+        # type: (Text, Text, int) -> None
+        with self._lock:
+            self._replace(tmp_path, path, size)
+            if self._current_size() > self.max_size:
+                self._evict()
+
+    def _replace(self, tmp_path, path, size):
+        # type: (Text, Text, int) -> None
+        """Move the temp file over `path`, an overwritten file no longer counts to the size"""
+        try:
+            replaced_size = os.path.getsize(path)
+        except OSError:
+            replaced_size = 0
+        os.replace(tmp_path, path)
+        if self._size is not None:
+            self._size += size - replaced_size
+
+    def _iter_entries(self):
+        """Yield (path, size with `.meta` sidecar, last use time) of cached entries"""
+        for root, _, files in os.walk(self.directory):
+            names = set(files)
+            for name in files:
+                if name.endswith((".tmp", ".meta")):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                    size = stat.st_size
+                    if name + ".meta" in names:
+                        size += os.path.getsize(path + ".meta")
+                except OSError:
+                    continue
+                yield path, size, stat.st_mtime
+
+    def _current_size(self):
+        # type: () -> int
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._iter_entries())
+        return self._size
+
+    def _evict(self):
+        # type: () -> None
+        entries = sorted(self._iter_entries(), key=lambda entry: entry[2])
+        size = sum(entry[1] for entry in entries)
+        low_water = self.max_size * LOW_WATER_RATIO
+        for path, entry_size, _ in entries:
+            if size <= low_water:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            if os.path.exists(path + ".meta"):
+                os.remove(path + ".meta")
+            size -= entry_size
+        self._size = size
+        log.info("Image cache {} evicted down to {} bytes".format(self.directory, size))
+
+
+_shared_image_cache = None  # type: Optional[ImageCache]
+_shared_image_cache_lock = threading.Lock()
+
+
+def get_shared_image_cache(options=None):
+    # type: (Optional[TestResultsHandlerOptions]) -> Optional[ImageCache]
+    """Return the process wide image cache, None if it is not configured."""
+    global _shared_image_cache
+    with _shared_image_cache_lock:
+        if _shared_image_cache is None and options and options.image_cache_dir:
+            _shared_image_cache = ImageCache(
+                options.image_cache_dir, options.image_cache_max_size * MEGABYTE
+            )
+        return _shared_image_cache
+
+
+def close_shared_image_cache():
+    # type: () -> Optional[ImageCache]
+    global _shared_image_cache
+    with _shared_image_cache_lock:
+        image_cache = _shared_image_cache
+        _shared_image_cache = None
+        return image_cache
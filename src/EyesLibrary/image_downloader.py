@@ -0,0 +1,105 @@
+from __future__ import absolute_import, unicode_literals
+
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Callable, Iterable, Optional, Text
+
+if TYPE_CHECKING:
+    from EyesLibrary.config import TestResultsHandlerOptions
+
+__all__ = ("ImageDownloader", "get_shared_downloader", "close_shared_downloader")
+
+
+class ImageDownloader(object):
+    """Bounded thread pool that fetches report images concurrently.
+
+    Images are keyed by url, so a url submitted ahead of time (prefetch)
+    is picked up by the later `result` call instead of being fetched again.
+    """
+
+    def __init__(self, max_workers=8):
+        # type: (int) -> None
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="EyesImageDownload"
+        )
+        self._pending = {}  # type: dict[Text, Future]
+        self._lock = threading.Lock()
+
+    def submit(self, url, fetch):
+        # type: (Text, Callable[[Text], Any]) -> Future
+        with self._lock:
+            future = self._pending.get(url)
+            if future is None:
+                future = self._executor.submit(fetch, url)
+                self._pending[url] = future
+            return future
+
+    def is_pending(self, url):
+        # type: (Text) -> bool
+        """Whether the image was submitted and is not picked up yet."""
+        with self._lock:
+            return url in self._pending
+
+    def put(self, url, image):
+        # type: (Text, Any) -> None
+        """Store an image fetched outside of the pool (e.g. by asyncio backend)."""
+        future = Future()
+        future.set_result(image)
+        with self._lock:
+            self._pending[url] = future
+
+    def result(self, url, fetch):
+        # type: (Text, Callable[[Text], Any]) -> Any
+        """Return fetched image and forget about it to free the memory."""
+        future = self.submit(url, fetch)
+        try:
+            return future.result()
+        finally:
+            with self._lock:
+                if self._pending.get(url) is future:
+                    del self._pending[url]
+
+    def discard(self, urls):
+        # type: (Iterable[Text]) -> None
+        """Forget images that won't be picked up, cancelling not started downloads."""
+        with self._lock:
+            for url in urls:
+                future = self._pending.pop(url, None)
+                if future is not None:
+                    future.cancel()
+
+    def shutdown(self):
+        # type: () -> None
+        with self._lock:
+            for future in self._pending.values():
+                future.cancel()
+            self._pending.clear()
+        self._executor.shutdown(wait=True)
+
+
+_shared_downloader = None  # type: Optional[ImageDownloader]
+_shared_downloader_lock = threading.Lock()
+
+
+def get_shared_downloader(options=None):
+    # type: (Optional[TestResultsHandlerOptions]) -> ImageDownloader
+    """Return the process wide downloader, creating it from `options` if needed."""
+    global _shared_downloader
+    with _shared_downloader_lock:
+        if _shared_downloader is None:
+            if options is None:
+                _shared_downloader = ImageDownloader()
+            else:
+                _shared_downloader = ImageDownloader(options.max_workers)
+        return _shared_downloader
+
+
+def close_shared_downloader():
+    # type: () -> None
+    global _shared_downloader
+    with _shared_downloader_lock:
+        if _shared_downloader is None:
+            return
+        _shared_downloader.shutdown()
+        _shared_downloader = None
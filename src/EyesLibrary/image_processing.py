@@ -0,0 +1,142 @@
+from __future__ import absolute_import, unicode_literals
+
+import io
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING, Any, Callable, Optional, Text
+
+from PIL import Image
+
+from .config import ThumbnailFormat
+
+if TYPE_CHECKING:
+    from EyesLibrary.config import TestResultsHandlerOptions
+
+__all__ = (
+    "ImageEncoder",
+    "encode_image",
+    "make_thumbnail",
+    "sniff_image_format",
+    "get_shared_image_encoder",
+    "close_shared_image_encoder",
+    "IMAGE_FORMAT_TO_MIME_TYPE",
+    "IMAGE_FORMAT_TO_EXTENSION",
+)
+
+IMAGE_FORMAT_TO_MIME_TYPE = {
+    ThumbnailFormat.JPEG: "image/jpeg",
+    ThumbnailFormat.WEBP: "image/webp",
+}
+IMAGE_FORMAT_TO_EXTENSION = {
+    ThumbnailFormat.JPEG: "jpg",
+    ThumbnailFormat.WEBP: "webp",
+}
+# leading bytes of image files -> (extension, mime type)
+_IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", ("png", "image/png")),
+    (b"\xff\xd8\xff", ("jpg", "image/jpeg")),
+    (b"GIF8", ("gif", "image/gif")),
+)
+
+
+def sniff_image_format(head):
+    # type: (bytes) -> tuple[Text, Text]
+    """Return (extension, mime type) of image by its first bytes, PNG if unknown."""
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp", "image/webp"
+    for signature, image_format in _IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return image_format
+    return "png", "image/png"
+
+
+def _save(image, image_format, quality):
+    # type: (Image.Image, ThumbnailFormat, int) -> bytes
+    if image_format is ThumbnailFormat.JPEG and image.mode not in ("RGB", "L"):
+        # JPEG has no alpha channel
+        image = image.convert("RGB")
+    output = io.BytesIO()
+    image.save(output, format=image_format.value, quality=quality)
+    return output.getvalue()
+
+
+def make_thumbnail(content, max_size, image_format=ThumbnailFormat.JPEG, quality=75):
+    # type: (bytes, int, ThumbnailFormat, int) -> bytes
+    """Downscale image to fit into `max_size` x `max_size` box keeping aspect ratio."""
+    image = Image.open(io.BytesIO(content))
+    image.thumbnail((max_size, max_size), Image.LANCZOS)
+    return _save(image, image_format, quality)
+
+
+def encode_image(content, image_format=ThumbnailFormat.JPEG, quality=85):
+    # type: (bytes, ThumbnailFormat, int) -> bytes
+    """Re-encode full size image into more compact format."""
+    return _save(Image.open(io.BytesIO(content)), image_format, quality)
+
+
+class ImageEncoder(object):
+    """Runs CPU bound image encoding in a process pool, so it neither holds
+    the GIL of download threads nor the memory of decoded images.
+
+    With `max_workers=0` functions run in the calling thread. The pool is
+    started by the first `run`, so runs that encode no images start no processes.
+    """
+
+    def __init__(self, max_workers=None):
+        # type: (Optional[int]) -> None
+        self.max_workers = max_workers
+        self._executor = None  # type: Optional[ProcessPoolExecutor]
+        self._lock = threading.Lock()
+
+    def _create_executor(self):
+        # type: () -> ProcessPoolExecutor
+        # forked children would inherit locks held by download threads and robot state
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("forkserver")
+        else:
+            context = multiprocessing.get_context("spawn")
+        return ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+
+    def run(self, func, *args):
+        # type: (Callable, *Any) -> Any
+        """Run module level `func` in the pool and wait for its result."""
+        if self.max_workers == 0:
+            return func(*args)
+        with self._lock:
+            if self._executor is None:
+                self._executor = self._create_executor()
+            executor = self._executor
+        return executor.submit(func, *args).result()
+
+    def shutdown(self):
+        # type: () -> None
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+_shared_image_encoder = None  # type: Optional[ImageEncoder]
+_shared_image_encoder_lock = threading.Lock()
+
+
+def get_shared_image_encoder(options=None):
+    # type: (Optional[TestResultsHandlerOptions]) -> ImageEncoder
+    """Return the process wide encoder, creating it from `options` if needed."""
+    global _shared_image_encoder
+    with _shared_image_encoder_lock:
+        if _shared_image_encoder is None:
+            _shared_image_encoder = ImageEncoder(
+                options.image_encoding_workers if options else None
+            )
+        return _shared_image_encoder
+
+
+def close_shared_image_encoder():
+    # type: () -> None
+    global _shared_image_encoder
+    with _shared_image_encoder_lock:
+        if _shared_image_encoder is not None:
+            _shared_image_encoder.shutdown()
+        _shared_image_encoder = None
@@ -154,6 +154,7 @@ class SessionKeywords(LibraryComponent):
         """
         Closes a session and returns the results of the session.
         If a test is running, aborts it. Otherwise, does nothing.
+        With `test_results_handler.harvest_results_on_test_end` enabled it waits for the results.
 
             | =Arguments=                  | =Description=                                                                                                           |
             | Raise Exception (bool)       | If you don't want an exception to be thrown if there are new, missing or mismatched steps, pass 'False' in the variable |
@@ -161,6 +162,17 @@ class SessionKeywords(LibraryComponent):
             | Eyes Close Async | ${false} |
         """
         # TODO: proper handle situation when we ask to raise an exception
+        if (
+            self.ctx.configure.propagate_eyes_test_results
+            and self.ctx.ROBOT_LIBRARY_LISTENER.test_results_manager.is_harvesting_enabled()
+        ):
+            # wait for results of this test, so they are retrieved in background
+            # while next tests run instead of at the end of the run
+            test_results = self.current_eyes.close(False)
+            self.ctx.ROBOT_LIBRARY_LISTENER.test_results_manager.register_eyes_test_closed(
+                test_results
+            )
+            return test_results
         return self.current_eyes.close_async()
 
     @keyword(
@@ -0,0 +1,88 @@
+from __future__ import absolute_import, unicode_literals
+
+import random
+import time
+from email.utils import mktime_tz, parsedate_tz
+from typing import TYPE_CHECKING, Optional, Text
+
+if TYPE_CHECKING:
+    import requests
+
+__all__ = ("LongRequestPoller", "LongRequestTimeout", "parse_retry_after")
+
+
+class LongRequestTimeout(Exception):
+    pass
+
+
+def parse_retry_after(value):
+    # type: (Optional[Text]) -> Optional[float]
+    """Return delay in seconds from `Retry-After` header (seconds or http date)."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0.0, mktime_tz(parsed) - time.time())
+
+
+class LongRequestPoller(object):
+    """Wait schedule for polling of one long running server task.
+
+    Delays grow exponentially up to `max_delay` with random jitter, so many
+    sessions don't poll the server in lockstep. `Retry-After` of the server
+    takes precedence. Polling fails once the request `timeout` or the global
+    `deadline` (`time.monotonic()` based) is reached.
+    """
+
+    def __init__(
+        self,
+        initial_delay,  # type: float
+        max_delay=10,  # type: float
+        multiplier=1.5,  # type: float
+        jitter=0.2,  # type: float
+        timeout=None,  # type: Optional[float]
+        deadline=None,  # type: Optional[float]
+    ):
+        # type: (...) -> None
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.started = time.monotonic()
+        self.deadline = deadline
+        if timeout is not None:
+            request_deadline = self.started + timeout
+            if deadline is None or request_deadline < deadline:
+                self.deadline = request_deadline
+        self.waited = 0.0
+        self.polls = 0
+        self._delay = min(max_delay, initial_delay)
+
+    def remaining(self):
+        # type: () -> Optional[float]
+        if self.deadline is None:
+            return None
+        return self.deadline - time.monotonic()
+
+    def next_delay(self, response):
+        # type: (requests.Response) -> float
+        """Return how long to wait before the next poll, account it as waited."""
+        delay = parse_retry_after(response.headers.get("Retry-After"))
+        if delay is None:
+            delay = self._delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+            self._delay = min(self.max_delay, self._delay * self.multiplier)
+        remaining = self.remaining()
+        if remaining is not None:
+            if remaining <= 0:
+                raise LongRequestTimeout(
+                    "Long request is not completed after {:.1f} s".format(
+                        time.monotonic() - self.started
+                    )
+                )
+            delay = min(delay, remaining)
+        self.waited += delay
+        self.polls += 1
+        return delay
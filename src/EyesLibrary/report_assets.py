@@ -0,0 +1,132 @@
+from __future__ import absolute_import, unicode_literals
+
+import hashlib
+import os
+import posixpath
+import tempfile
+import threading
+from typing import TYPE_CHECKING, Optional, Text
+
+from six.moves.urllib.parse import quote
+
+if TYPE_CHECKING:
+    from EyesLibrary.config import TestResultsHandlerOptions
+
+__all__ = ("ReportAssets", "get_shared_report_assets", "close_shared_report_assets")
+
+
+class ReportAssets(object):
+    """Directory with report images, referenced from `log.html` by relative path
+    instead of being inlined as base64.
+
+    Images are content addressed (named by hash of their bytes), so an image
+    repeated in many steps or tests is stored once and shared by all cells.
+    """
+
+    def __init__(self, directory, link_prefix):
+        # type: (Text, Text) -> None
+        self.directory = directory
+        self.link_prefix = link_prefix
+        self._aliases = {}  # type: dict[Text, Text]
+        self._lock = threading.Lock()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    @classmethod
+    def from_options(cls, options, output_dir, log_dir=None):
+        # type: (TestResultsHandlerOptions, Text, Optional[Text]) -> ReportAssets
+        """Create assets dir inside Robot output dir, linked relatively to log dir."""
+        directory = os.path.join(output_dir, options.report_assets_dir)
+        link_prefix = os.path.relpath(directory, log_dir or output_dir)
+        return cls(directory, link_prefix.replace(os.sep, "/"))
+
+    def path(self, name):
+        # type: (Text) -> Text
+        return os.path.join(self.directory, name)
+
+    def link(self, name):
+        # type: (Text) -> Text
+        return posixpath.join(self.link_prefix, quote(name))
+
+    def exists(self, name):
+        # type: (Text) -> bool
+        return os.path.exists(self.path(name))
+
+    def get_alias(self, alias):
+        # type: (Text) -> Optional[Text]
+        """Return name of the asset stored earlier for `alias` (e.g. image url)."""
+        with self._lock:
+            return self._aliases.get(alias)
+
+    def _set_alias(self, alias, name):
+        # type: (Optional[Text], Text) -> None
+        if alias is not None:
+            with self._lock:
+                self._aliases[alias] = name
+
+    @staticmethod
+    def content_name(digest, extension="png"):
+        # type: (Text, Text) -> Text
+        return "{}.{}".format(digest, extension)
+
+    def add(self, content, alias=None, extension="png"):
+        # type: (bytes, Optional[Text], Text) -> Text
+        """Store image unless identical one is stored already, return its name."""
+        name = self.content_name(hashlib.sha1(content).hexdigest(), extension)
+        if not self.exists(name):
+            self.write(name, content)
+        self._set_alias(alias, name)
+        return name
+
+    def add_file(self, path, alias=None, extension="png"):
+        # type: (Text, Optional[Text], Text) -> Text
+        """Move downloaded image into assets, return its name."""
+        digest = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b""):
+                digest.update(chunk)
+        name = self.content_name(digest.hexdigest(), extension)
+        if self.exists(name):
+            os.remove(path)
+        else:
+            os.replace(path, self.path(name))
+        self._set_alias(alias, name)
+        return name
+
+    def temp_path(self):
+        # type: () -> Text
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        os.close(fd)
+        return tmp_path
+
+    def write(self, name, content):
+        # type: (Text, bytes) -> Text
+        """Atomically write asset and return its link."""
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, self.path(name))
+        return self.link(name)
+
+
+_shared_report_assets = None  # type: Optional[ReportAssets]
+_shared_report_assets_lock = threading.Lock()
+
+
+def get_shared_report_assets(options=None, output_dir=None, log_dir=None):
+    # type: (Optional[TestResultsHandlerOptions], Optional[Text], Optional[Text]) -> Optional[ReportAssets]
+    """Return the process wide report assets, None if not configured."""
+    global _shared_report_assets
+    with _shared_report_assets_lock:
+        if _shared_report_assets is None and options and output_dir:
+            _shared_report_assets = ReportAssets.from_options(
+                options, output_dir, log_dir
+            )
+        return _shared_report_assets
+
+
+def close_shared_report_assets():
+    # type: () -> None
+    global _shared_report_assets
+    with _shared_report_assets_lock:
+        _shared_report_assets = None
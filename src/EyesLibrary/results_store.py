@@ -0,0 +1,140 @@
+from __future__ import absolute_import, unicode_literals
+
+import pathlib
+import sqlite3
+from typing import Generator, Optional, Text
+
+__all__ = ("SqliteResultsStore", "is_sqlite_file")
+
+_SQLITE_HEADER = b"SQLite format 3\x00"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tests (
+    id INTEGER PRIMARY KEY,
+    suite TEXT NOT NULL,
+    test_name TEXT NOT NULL,
+    status TEXT NOT NULL,
+    test_results_url TEXT
+);
+CREATE INDEX IF NOT EXISTS tests_suite_test_name ON tests (suite, test_name);
+CREATE INDEX IF NOT EXISTS tests_status ON tests (status);
+CREATE TABLE IF NOT EXISTS steps (
+    test_id INTEGER NOT NULL REFERENCES tests (id),
+    step_index INTEGER NOT NULL,
+    is_different INTEGER NOT NULL,
+    url TEXT,
+    step_result_html TEXT,
+    PRIMARY KEY (test_id, step_index)
+);
+CREATE INDEX IF NOT EXISTS steps_is_different ON steps (is_different);
+"""
+
+
+def is_sqlite_file(path):
+    # type: (Text) -> bool
+    with open(path, "rb") as f:
+        return f.read(len(_SQLITE_HEADER)) == _SQLITE_HEADER
+
+
+class SqliteResultsStore(object):
+    """Eyes test and step results of a run in a local SQLite file.
+
+    Every appended test is committed at once, so results written before
+    a crash survive. Tests are indexed by suite, test name and status,
+    e.g. diff steps of a suite are queried by `iter_diff_steps`.
+    """
+
+    def __init__(self, path, read_only=False):
+        # type: (Text, bool) -> None
+        self.path = path
+        if read_only:
+            # quoted file URI, so `?` and `#` in the path aren't parsed as URI syntax
+            uri = pathlib.Path(path).resolve().as_uri() + "?mode=ro"
+            self._connection = sqlite3.connect(uri, uri=True)
+        else:
+            self._connection = sqlite3.connect(path)
+            self._connection.executescript(_SCHEMA)
+        self._connection.row_factory = sqlite3.Row
+
+    def append(self, suite_name, test_result):
+        # type: (Text, dict) -> None
+        with self._connection:
+            cursor = self._connection.execute(
+                "INSERT INTO tests (suite, test_name, status, test_results_url) "
+                "VALUES (?, ?, ?, ?)",
+                (
+                    suite_name,
+                    test_result["test_name"],
+                    test_result["test_status"],
+                    test_result["test_results_url"],
+                ),
+            )
+            self._connection.executemany(
+                "INSERT INTO steps (test_id, step_index, is_different, url, step_result_html) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (
+                    (
+                        cursor.lastrowid,
+                        step_index,
+                        step["is_different"],
+                        step["url"],
+                        step.get("step_result_html"),
+                    )
+                    for step_index, step in enumerate(test_result["steps"])
+                ),
+            )
+
+    def has_suite(self, suite_name):
+        # type: (Text) -> bool
+        return (
+            self._connection.execute(
+                "SELECT 1 FROM tests WHERE suite = ? LIMIT 1", (suite_name,)
+            ).fetchone()
+            is not None
+        )
+
+    def iter_suite(self, suite_name, status=None):
+        # type: (Text, Optional[Text]) -> Generator[dict, None, None]
+        """Yield test results of the suite in the format they were appended in"""
+        query = "SELECT * FROM tests WHERE suite = ?"
+        params = [suite_name]
+        if status is not None:
+            query += " AND status = ?"
+            params.append(status)
+        for test in self._connection.execute(query + " ORDER BY id", params).fetchall():
+            yield dict(
+                test_name=test["test_name"],
+                test_status=test["status"],
+                test_results_url=test["test_results_url"],
+                steps=[
+                    self._step_info(step)
+                    for step in self._connection.execute(
+                        "SELECT * FROM steps WHERE test_id = ? ORDER BY step_index",
+                        (test["id"],),
+                    )
+                ],
+            )
+
+    @staticmethod
+    def _step_info(step):
+        # type: (sqlite3.Row) -> dict
+        step_info = dict(is_different=bool(step["is_different"]), url=step["url"])
+        if step["step_result_html"] is not None:
+            step_info["step_result_html"] = step["step_result_html"]
+        return step_info
+
+    def iter_diff_steps(self, suite_name):
+        # type: (Text) -> Generator[dict, None, None]
+        """Yield mismatching steps of the suite without their html"""
+        for row in self._connection.execute(
+            "SELECT tests.test_name, steps.step_index, steps.url FROM steps "
+            "JOIN tests ON tests.id = steps.test_id "
+            "WHERE tests.suite = ? AND steps.is_different "
+            "ORDER BY tests.id, steps.step_index",
+            (suite_name,),
+        ):
+            yield dict(row)
+
+    def close(self):
+        # type: () -> None
+        self._connection.close()
@@ -0,0 +1,77 @@
+from __future__ import absolute_import, unicode_literals
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Optional, Text
+
+from .ApplitoolsTestResultHandler import ApplitoolsTestResultsHandler
+
+if TYPE_CHECKING:
+    from applitools.common import TestResults
+
+    from .http_session import ResultsHttpSession
+    from .image_cache import ImageCache
+
+__all__ = ("SessionJsonLoader",)
+
+log = logging.getLogger("SessionJsonLoader")
+
+
+class SessionJsonLoader(object):
+    """Loads test JSON of many Eyes sessions before their handlers are created.
+
+    Eyes API has no documented endpoint returning step details of all
+    sessions of a batch, so sessions are requested concurrently over the
+    pooled connections instead of one by one inside handler constructors.
+    Sessions that fail to load are left out and fetched by their handler.
+    """
+
+    def __init__(self, view_key, http_session, max_workers=8, image_cache=None):
+        # type: (Text, ResultsHttpSession, int, Optional[ImageCache]) -> None
+        self.view_key = view_key
+        self.http = http_session
+        self.max_workers = max_workers
+        self.image_cache = image_cache
+
+    def load(self, test_results_list):
+        # type: (list[TestResults]) -> dict
+        """Return {(batch_id, session_id): test JSON} of given tests."""
+        sessions = {}
+        for test_results in test_results_list:
+            session_key = ApplitoolsTestResultsHandler.get_session_key(test_results)
+            if session_key not in sessions:
+                sessions[session_key] = ApplitoolsTestResultsHandler.get_server_url(
+                    test_results
+                )
+        if not sessions:
+            return {}
+        with ThreadPoolExecutor(
+            max_workers=min(self.max_workers, len(sessions)),
+            thread_name_prefix="EyesSessionLoader",
+        ) as executor:
+            futures = dict(
+                (
+                    session_key,
+                    executor.submit(
+                        ApplitoolsTestResultsHandler.request_test_json,
+                        self.http,
+                        server_url,
+                        session_key[0],
+                        session_key[1],
+                        self.view_key,
+                        self.image_cache,
+                    ),
+                )
+                for session_key, server_url in sessions.items()
+            )
+        test_json = {}
+        for session_key, future in futures.items():
+            try:
+                test_json[session_key] = future.result()
+            except Exception as e:
+                log.warning(
+                    "Failed to preload session {}/{}: {}".format(
+                        session_key[0], session_key[1], e
+                    )
+                )
+        return test_json
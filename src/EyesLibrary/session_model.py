@@ -0,0 +1,127 @@
+from __future__ import absolute_import, unicode_literals
+
+from enum import Enum
+from typing import Any, Optional, Text
+
+__all__ = ("ResultStatus", "SessionModel")
+
+
+class ResultStatus(Enum):
+    PASSED = "passed"
+    FAILED = "failed"
+    NEW = "new"
+    MISSING = "missing"
+
+
+# steps having baseline image and checkpoint image respectively
+BASELINE_STATES = frozenset((ResultStatus.PASSED, ResultStatus.FAILED, ResultStatus.MISSING))
+CHECKPOINT_STATES = frozenset((ResultStatus.PASSED, ResultStatus.FAILED, ResultStatus.NEW))
+
+
+def _get(items, index):
+    # type: (list, int) -> Any
+    return items[index] if index < len(items) else None
+
+
+def _image_id(output):
+    # type: (Optional[dict]) -> Optional[Text]
+    # outputs of some steps (e.g. aborted ones) have no image
+    try:
+        return output["image"]["id"]
+    except (TypeError, KeyError):
+        return None
+
+
+class SessionModel(object):
+    """Fields of Eyes session JSON the results handlers use, parsed once.
+
+    Per step values are tuples indexed by step index, missing baseline or
+    checkpoint outputs are None.
+    """
+
+    __slots__ = (
+        "status",
+        "scenario_name",
+        "test_name",
+        "host_os",
+        "host_app",
+        "display_width",
+        "display_height",
+        "baseline_hosting_app",
+        "step_states",
+        "baseline_tags",
+        "checkpoint_tags",
+        "baseline_image_ids",
+        "checkpoint_image_ids",
+    )
+
+    def __init__(self, test_json):
+        # type: (dict) -> None
+        start_info = test_json["startInfo"]
+        environment = start_info["environment"]
+        self.status = test_json["status"]  # type: Text
+        self.scenario_name = test_json["scenarioName"]  # type: Text
+        self.test_name = start_info["scenarioName"]  # type: Text
+        self.host_os = environment["osInfo"]  # type: Text
+        self.host_app = environment["hostingAppInfo"]  # type: Text
+        self.display_width = environment["displaySize"]["width"]  # type: int
+        self.display_height = environment["displaySize"]["height"]  # type: int
+        self.baseline_hosting_app = (test_json.get("baselineEnv") or {}).get(
+            "hostingApp"
+        )  # type: Optional[Text]
+
+        expected = test_json["expectedAppOutput"]
+        actual = test_json["actualAppOutput"]
+        steps = range(max(len(expected), len(actual)))
+        baselines = tuple(_get(expected, i) for i in steps)
+        checkpoints = tuple(_get(actual, i) for i in steps)
+        self.step_states = tuple(
+            self._step_state(baseline, checkpoint)
+            for baseline, checkpoint in zip(baselines, checkpoints)
+        )  # type: tuple[ResultStatus, ...]
+        self.baseline_tags = tuple(
+            None if output is None else output["tag"] for output in baselines
+        )  # type: tuple[Optional[Text], ...]
+        self.checkpoint_tags = tuple(
+            None if output is None else output["tag"] for output in checkpoints
+        )  # type: tuple[Optional[Text], ...]
+        self.baseline_image_ids = tuple(
+            _image_id(output) for output in baselines
+        )  # type: tuple[Optional[Text], ...]
+        self.checkpoint_image_ids = tuple(
+            _image_id(output) for output in checkpoints
+        )  # type: tuple[Optional[Text], ...]
+
+    @staticmethod
+    def _step_state(baseline, checkpoint):
+        # type: (Optional[dict], Optional[dict]) -> ResultStatus
+        if checkpoint is None:
+            return ResultStatus.MISSING
+        if baseline is None:
+            return ResultStatus.NEW
+        if checkpoint["isMatching"]:
+            return ResultStatus.PASSED
+        return ResultStatus.FAILED
+
+    def __len__(self):
+        return len(self.step_states)
+
+    def has_baseline(self, step_index):
+        # type: (int) -> bool
+        return self.step_states[step_index] in BASELINE_STATES
+
+    def has_checkpoint(self, step_index):
+        # type: (int) -> bool
+        return self.step_states[step_index] in CHECKPOINT_STATES
+
+    def baseline_image_id(self, step_index):
+        # type: (int) -> Optional[Text]
+        return _get(self.baseline_image_ids, step_index)
+
+    def checkpoint_image_id(self, step_index):
+        # type: (int) -> Optional[Text]
+        return _get(self.checkpoint_image_ids, step_index)
+
+    def is_failed(self, step_index):
+        # type: (int) -> bool
+        return self.step_states[step_index] is ResultStatus.FAILED
@@ -1,31 +1,53 @@
 from __future__ import absolute_import, unicode_literals
 
+import itertools
 import json
+import logging
 import os
+import re
 import tempfile
 import uuid
-from collections import defaultdict
-from typing import TYPE_CHECKING, Generator, Optional, Text
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Generator, Iterable, Optional, Text, Union
 
 from robot.api import logger as robot_logger
+from robot.libraries.BuiltIn import BuiltIn
 from robot.utils import get_timestamp
 
 from applitools.common.test_results import TestResultsStatus
 
 from .keywords_list import CHECK_KEYWORDS_LIST
 
+from .async_results import AsyncResultsRetriever
 from .base import LibraryComponent
 from .ApplitoolsBase64TestResultHandler import ApplitoolsBase64TestResultHandler
+from .config import ReportImages, ReportImageStorage, ResultsFormat, TestResultsBackend
+from .http_session import close_shared_session, get_shared_session
+from .image_cache import close_shared_image_cache, get_shared_image_cache
+from .image_downloader import close_shared_downloader, get_shared_downloader
+from .image_processing import close_shared_image_encoder, get_shared_image_encoder
+from .report_assets import close_shared_report_assets, get_shared_report_assets
+from .results_store import SqliteResultsStore, is_sqlite_file
+from .session_loader import SessionJsonLoader
 
 from robot.model.keyword import Keyword
 
 if TYPE_CHECKING:
-    from robot.running import TestSuite
+    from robot.running import TestCase, TestSuite
 
     from applitools.common import TestResults, TestResultsSummary
     from EyesLibrary.config import RobotConfiguration
+    from EyesLibrary.image_cache import ImageCache
 
-__all__ = ["EyesToRobotTestResultsManager", "SuitePostProcessManager"]
+__all__ = [
+    "EyesToRobotTestResultsManager",
+    "SuitePostProcessManager",
+    "SuiteResultsCache",
+]
+
+# Robot logger ignores messages of threads other than the main one, harvester logs here
+log = logging.getLogger("EyesToRobotTestResultsManager")
 
 EYES_STATUS_TO_ROBOT_STATUS = {
     TestResultsStatus.Passed: "PASS",
@@ -37,87 +59,315 @@ METADATA_EYES_TEST_RESULTS_URL_NAME = "Applitools Test Results Url"
 EYES_TEST_JSON_NAME = "EyesTestResults"
 
 
-def save_suites(path_to_test_results, suites):
-    # type: (Text, dict[list[dict]]) -> None
-    results = json.dumps(suites)
-    with open(path_to_test_results, "w") as f:
-        f.write(results)
+JSON_LINES_RESULTS_FORMAT = "jsonl"
+SQLITE_RESULTS_FORMAT = "sqlite"
+# results directory shared by parallel workers, each writes its own index
+MERGED_RESULTS_FORMAT = "merged"
+
+
+def get_shard_path(path_to_test_results, shard_name):
+    # type: (Text, Text) -> Text
+    return os.path.join(os.path.dirname(path_to_test_results), shard_name)
+
+
+class JsonLinesResultsWriter(object):
+    """Appends results of every test as one JSON line to the shard of its suite
+    as soon as they are ready, `close` writes the index file `path_to_test_results`
+    mapping suite names to shard file names"""
+
+    def __init__(self, path_to_test_results):
+        # type: (Text) -> None
+        self.path_to_test_results = path_to_test_results
+        self._base_name = os.path.splitext(os.path.basename(path_to_test_results))[0]
+        self._shards = {}  # type: dict[Text, Text]
+
+    def append(self, suite_name, test_result):
+        # type: (Text, dict) -> None
+        shard_name = self._shards.get(suite_name)
+        mode = "a"
+        if shard_name is None:
+            shard_name = "{}-{}.jsonl".format(self._base_name, len(self._shards))
+            self._shards[suite_name] = shard_name
+            # shard left by previous writer to the same path is overwritten
+            mode = "w"
+        with open(get_shard_path(self.path_to_test_results, shard_name), mode) as f:
+            f.write(json.dumps(test_result))
+            f.write("\n")
+
+    def close(self):
+        # type: () -> None
+        with open(self.path_to_test_results, "w") as f:
+            json.dump(dict(format=JSON_LINES_RESULTS_FORMAT, suites=self._shards), f)
 
 
-def restore_suite(path_to_test_results):
-    # type: (Text) -> dict[list[dict]]
+def save_suites(path_to_test_results, suites):
+    # type: (Text, dict[list[dict]]) -> None
+    writer = JsonLinesResultsWriter(path_to_test_results)
+    for suite_name, suite_results in suites.items():
+        for test_result in suite_results:
+            writer.append(suite_name, test_result)
+    writer.close()
+
+
+def list_worker_results(results_dir):
+    # type: (Text) -> list[Text]
+    """Return index files of all workers written to the shared `results_dir`"""
+    return [
+        os.path.join(results_dir, name)
+        for name in sorted(os.listdir(results_dir))
+        if name.startswith(EYES_TEST_JSON_NAME + "-")
+        and name.endswith((".json", ".sqlite"))
+    ]
+
+
+def get_run_results_dir(results_dir, run_id):
+    # type: (Text, Text) -> Text
+    """Return subdirectory of the shared `results_dir` holding results of one run"""
+    return os.path.join(os.path.abspath(results_dir), re.sub(r"[^\w.-]", "_", run_id))
+
+
+def iter_json_lines(path):
+    # type: (Text) -> Generator[dict, None, None]
+    with open(path, "r") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                test_result = json.loads(line)
+            except ValueError as e:
+                # e.g. the last line of a run that was killed while writing it
+                robot_logger.warn(
+                    "Skipped undecodable line {} of Eyes results {}: {}".format(
+                        line_number, path, e
+                    )
+                )
+                continue
+            yield test_result
+
+
+def load_results_index(path_to_test_results):
+    # type: (Text) -> tuple[Optional[Text], Any]
+    """Return (format, {suite name: shard name or suite results}),
+    SQLite results are returned as opened `SqliteResultsStore`,
+    shared results directory as [(worker index path, its results index)]"""
+    if os.path.isdir(path_to_test_results):
+        return MERGED_RESULTS_FORMAT, [
+            (worker_path, load_results_index(worker_path))
+            for worker_path in list_worker_results(path_to_test_results)
+        ]
+    if is_sqlite_file(path_to_test_results):
+        return SQLITE_RESULTS_FORMAT, SqliteResultsStore(
+            path_to_test_results, read_only=True
+        )
     with open(path_to_test_results, "r") as f:
-        return json.load(f)
+        index = json.load(f)
+    if index.get("format") != JSON_LINES_RESULTS_FORMAT:
+        # single file with results of all suites of older versions
+        return None, index
+    return index["format"], index["suites"]
+
+
+def restore_suite(path_to_test_results, suite_name):
+    # type: (Text, Text) -> list[dict]
+    """Load results of a single suite, raise KeyError if it has none"""
+    results_cache = SuiteResultsCache()
+    try:
+        return list(results_cache.get(path_to_test_results, suite_name))
+    finally:
+        results_cache.release(path_to_test_results)
+
+
+class SuiteResultsCache(object):
+    """Results files parsed once for all suites of the post-processed tree.
+
+    Suites of a run share one results file, entries are kept until
+    `release` and only the shard of the requested suite is read.
+    """
+
+    def __init__(self):
+        self._indexes = {}  # type: dict[Text, tuple[Optional[Text], Any]]
+
+    def get(self, path_to_test_results, suite_name):
+        # type: (Text, Text) -> Iterable[dict]
+        """Return results of the suite tests, JSON Lines shards are read lazily"""
+        if path_to_test_results not in self._indexes:
+            self._indexes[path_to_test_results] = load_results_index(
+                path_to_test_results
+            )
+        return self._get_suite_results(
+            path_to_test_results, self._indexes[path_to_test_results], suite_name
+        )
+
+    def _get_suite_results(self, path_to_test_results, results_index, suite_name):
+        # type: (Text, tuple[Optional[Text], Any], Text) -> Iterable[dict]
+        results_format, suites = results_index
+        if results_format == MERGED_RESULTS_FORMAT:
+            # the suite may have been split between workers
+            worker_results = []
+            for worker_path, worker_index in suites:
+                try:
+                    worker_results.append(
+                        self._get_suite_results(worker_path, worker_index, suite_name)
+                    )
+                except KeyError:
+                    continue
+            if not worker_results:
+                raise KeyError(suite_name)
+            return itertools.chain.from_iterable(worker_results)
+        if results_format == SQLITE_RESULTS_FORMAT:
+            if not suites.has_suite(suite_name):
+                raise KeyError(suite_name)
+            return suites.iter_suite(suite_name)
+        if results_format is None:
+            return suites[suite_name]
+        return iter_json_lines(get_shard_path(path_to_test_results, suites[suite_name]))
+
+    def is_loaded(self, path_to_test_results):
+        # type: (Text) -> bool
+        return path_to_test_results in self._indexes
+
+    def release(self, path_to_test_results):
+        # type: (Text) -> None
+        results_index = self._indexes.pop(path_to_test_results, None)
+        if results_index is not None:
+            self._close(results_index)
+
+    def _close(self, results_index):
+        # type: (tuple[Optional[Text], Any]) -> None
+        results_format, suites = results_index
+        if results_format == SQLITE_RESULTS_FORMAT:
+            suites.close()
+        elif results_format == MERGED_RESULTS_FORMAT:
+            for _, worker_index in suites:
+                self._close(worker_index)
 
 
 class SuitePostProcessManager(object):
     """Update Suite with data from json saved by `EyesToRobotTestResultsManager`"""
 
-    def __init__(self, robot_suite):
-        # type: (TestSuite) -> None
+    def __init__(self, robot_suite, results_cache=None):
+        # type: (TestSuite, Optional[SuiteResultsCache]) -> None
         self.robot_test_suite = robot_suite
-        self.current_suite = None  # type: Optional[list[dict]]
+        self.results_cache = (
+            results_cache if results_cache is not None else SuiteResultsCache()
+        )
+        self.current_suite = None  # type: Optional[Iterable[dict]]
+        self.check_keyword_names = frozenset(CHECK_KEYWORDS_LIST)
+        # id of keyword -> its parent keywords, the tree is alive while processed
+        self._parent_chains = {}  # type: dict[int, tuple[Keyword, ...]]
+
+    @staticmethod
+    def get_results_path(robot_suite):
+        # type: (TestSuite) -> Optional[Text]
+        return robot_suite.metadata.get(METADATA_PATH_TO_EYES_RESULTS_NAME)
 
     def import_suite_data(self):
         # type: () -> None
-        path_to_test_results = self.robot_test_suite.metadata.get(
-            METADATA_PATH_TO_EYES_RESULTS_NAME
-        )
+        path_to_test_results = self.get_results_path(self.robot_test_suite)
         if path_to_test_results is None:
             raise KeyError(
                 "No `{}` found in metadata".format(METADATA_PATH_TO_EYES_RESULTS_NAME)
             )
-        if not os.path.exists(path_to_test_results):
+        if not self.results_cache.is_loaded(
+            path_to_test_results
+        ) and not os.path.exists(path_to_test_results):
             raise FileNotFoundError("File `{}` not found".format(path_to_test_results))
-        suites_results_data = restore_suite(path_to_test_results)
-        self.current_suite = suites_results_data[self.robot_test_suite.name]
+        self.current_suite = self.results_cache.get(
+            path_to_test_results, self.robot_test_suite.name
+        )
+
+    @staticmethod
+    def get_child_keywords(item):
+        if hasattr(item, 'keywords'):
+            keywords = item.keywords
+            if len(keywords) > 0:
+                return keywords
+        return None
 
     def get_eyes_keywords(self, item):
-        if hasattr(item, 'keywords') and len(item.keywords) > 0:
-            for kw in item.keywords:
-                if kw.libname == "EyesLibrary" and kw.kwname in CHECK_KEYWORDS_LIST:
-                    yield kw
-                if hasattr(kw, 'keywords') and len(kw.keywords) > 0:
-                    yield from self.get_eyes_keywords(kw)
+        # type: (Any) -> list[Keyword]
+        """Return check keywords called by the test (or keyword) in execution order,
+        collected in a single iterative walk"""
+        check_keyword_names = self.check_keyword_names
+        check_keywords = []
+        stack = [iter(self.get_child_keywords(item) or ())]
+        while stack:
+            for kw in stack[-1]:
+                if kw.libname == "EyesLibrary" and kw.kwname in check_keyword_names:
+                    check_keywords.append(kw)
+                children = self.get_child_keywords(kw)
+                if children is not None:
+                    # descend before the next sibling
+                    stack.append(iter(children))
+                    break
+            else:
+                stack.pop()
+        return check_keywords
 
     def get_parent_keywords(self, item):
-        if hasattr(item, 'parent') and isinstance(item.parent, Keyword):
-            yield item.parent
-            if hasattr(item.parent, 'parent'):
-                yield from self.get_parent_keywords(item.parent)
+        # type: (Any) -> tuple[Keyword, ...]
+        """Return parent keywords of the item, nearest first.
+        Chains are cached, so siblings share the walk to the test"""
+        missing = []
+        node = item
+        while id(node) not in self._parent_chains:
+            parent = getattr(node, 'parent', None)
+            if not isinstance(parent, Keyword):
+                self._parent_chains[id(node)] = ()
+                break
+            missing.append(node)
+            node = parent
+        chain = self._parent_chains[id(node)]
+        for node in reversed(missing):
+            chain = (node.parent,) + chain
+            self._parent_chains[id(node)] = chain
+        return chain
 
     def process_suite(self):
         # type: () -> None
-        if not self.current_suite:
+        """Apply results to the robot tests one test record at a time"""
+        robot_tests = defaultdict(list)
+        for robot_test in self.robot_test_suite.tests:
+            robot_tests[robot_test.name].append(robot_test)
+        test_results_url = None
+        for test_result in self.current_suite or ():
+            if test_results_url is None:
+                test_results_url = test_result["test_results_url"]
+            # non-eyes tests have no records
+            for robot_test in robot_tests.get(test_result["test_name"], ()):
+                self.process_test(robot_test, test_result)
+        if test_results_url is None:
             robot_logger.debug(
                 "No tests found. Skip updating of test results of {}".format(
                     self.robot_test_suite
                 )
             )
             return
-        robot_test_name_to_status = {
-            t["test_name"]: (t["test_status"], t["steps"]) for t in self.current_suite
-        }
-        for robot_test in self.robot_test_suite.tests:
-            if robot_test.name not in robot_test_name_to_status:
-                continue  # skip non-eyes tests
-            robot_test_status, steps_info = robot_test_name_to_status[robot_test.name]
-            robot_test.status = robot_test_status
-            check_keywords = self.get_eyes_keywords(robot_test)
-            for check_keyword, step_info in zip(check_keywords, steps_info):
-                if step_info["is_different"]:
-                    check_keyword.status = "FAIL"
-                    for parent_keyword in self.get_parent_keywords(check_keyword):
-                        parent_keyword.status = "FAIL"
-                check_keyword.messages.create(
-                    message=step_info["step_result_html"],
-                    timestamp=get_timestamp(),
-                    html=True
-                )
 
         self.robot_test_suite.metadata[
             METADATA_EYES_TEST_RESULTS_URL_NAME
-        ] = self.current_suite[0]["test_results_url"]
+        ] = test_results_url
+
+    def process_test(self, robot_test, test_result):
+        # type: (TestCase, dict) -> None
+        robot_test.status = test_result["test_status"]
+        check_keywords = self.get_eyes_keywords(robot_test)
+        failed_parents = set()
+        for check_keyword, step_info in zip(check_keywords, test_result["steps"]):
+            if step_info["is_different"]:
+                check_keyword.status = "FAIL"
+                for parent_keyword in self.get_parent_keywords(check_keyword):
+                    if id(parent_keyword) in failed_parents:
+                        break  # the rest of the chain is failed already
+                    failed_parents.add(id(parent_keyword))
+                    parent_keyword.status = "FAIL"
+            if not step_info.get("step_result_html"):
+                continue
+            check_keyword.messages.create(
+                message=step_info["step_result_html"],
+                timestamp=get_timestamp(),
+                html=True
+            )
 
 
 class EyesToRobotTestResultsManager(object):
@@ -131,16 +381,95 @@ class EyesToRobotTestResultsManager(object):
         if not self.configure.propagate_eyes_test_results:
             return
         self.test_id_to_suite = {}  # type: dict[Text, TestSuite]
-        output_dir = tempfile.mkdtemp()
-        self.path_to_test_results = os.path.join(
-            output_dir, "{}-{}.json".format(EYES_TEST_JSON_NAME, uuid.uuid4().hex)
+        # filled only during `register_eyes_test_results_on_close`
+        self.session_handlers = {}  # type: dict[tuple, ApplitoolsBase64TestResultHandler]
+        # sessions whose JSON couldn't be retrieved, not requested again by their other steps
+        self.failed_sessions = {}  # type: dict[tuple, Exception]
+        self.reported_failed_sessions = set()  # type: set[tuple]
+        self.preloaded_test_json = {}  # type: dict[tuple, dict]
+        # of handlers released once their test was written
+        self.long_request_wait_times = {}  # type: dict[Text, float]
+        # user test ids waiting for prefetch and those prefetched but not rendered yet
+        self.prefetch_queue = deque()  # type: deque[Text]
+        self.prefetched_test_ids = set()  # type: set[Text]
+        self.async_retriever = None  # type: Optional[AsyncResultsRetriever]
+        self.harvester = None  # type: Optional[ThreadPoolExecutor]
+        self.harvest_warned = False
+        self.user_test_id_to_test_results = defaultdict(list)  # type: dict[Text, list[TestResults]]
+        self.robot_output_dir = None  # type: Optional[Text]
+        self.robot_log_dir = None  # type: Optional[Text]
+        self.worker_id = uuid.uuid4().hex
+        # results directory shared by parallel (pabot) workers of the run,
+        # resolved when the first suite starts
+        self.results_dir = None  # type: Optional[Text]
+        self.path_to_test_results = None  # type: Optional[Text]
+        options = self.configure.test_results_handler
+        if options.results_dir:
+            if options.report_image_storage is ReportImageStorage.assets:
+                # asset links are relative to the log of the worker, not the merged one
+                robot_logger.warn(
+                    "test_results_handler.report_image_storage: assets can't be used "
+                    "with results_dir, report images are inlined instead"
+                )
+                options.report_image_storage = ReportImageStorage.inline
+        if (
+            options.thumbnail_max_size
+            and options.report_image_storage is not ReportImageStorage.assets
+        ):
+            robot_logger.warn(
+                "test_results_handler.thumbnail_max_size requires report_image_storage: "
+                "assets, report images are inlined in full size"
+            )
+        if not options.results_dir:
+            self.path_to_test_results = self.get_results_file_path(tempfile.mkdtemp())
+
+    def get_results_file_path(self, output_dir):
+        # type: (Text) -> Text
+        extension = "json"
+        if self.configure.test_results_handler.results_format is ResultsFormat.sqlite:
+            extension = "sqlite"
+        return os.path.join(
+            output_dir,
+            "{}-{}.{}".format(EYES_TEST_JSON_NAME, self.worker_id, extension),
         )
 
+    def get_run_id(self):
+        # type: () -> Text
+        """Return id shared by the workers of one run: their common Eyes batch id
+        (e.g. set by `APPLITOOLS_BATCH_ID`), workers of different batches aren't merged"""
+        batch = getattr(self.configure, "batch", None)
+        if batch is not None and batch.id:
+            return batch.id
+        return self.worker_id
+
+    def init_results_dir(self):
+        # type: () -> None
+        """Write results into the run subdirectory of the shared `results_dir`,
+        so results left there by other runs are never merged with this one"""
+        self.results_dir = get_run_results_dir(
+            self.configure.test_results_handler.results_dir, self.get_run_id()
+        )
+        if not os.path.exists(self.results_dir):
+            os.makedirs(self.results_dir, exist_ok=True)
+        self.path_to_test_results = self.get_results_file_path(self.results_dir)
+
     def register_robot_suite_started(self, data, result):
         # type: (TestSuite,TestSuite) -> None
         if not self.configure.propagate_eyes_test_results:
             return
-        result.metadata[METADATA_PATH_TO_EYES_RESULTS_NAME] = self.path_to_test_results
+        if self.path_to_test_results is None:
+            # batch of the run is configured once the library is imported
+            self.init_results_dir()
+        # suites merged from several workers are resolved through the shared directory
+        result.metadata[METADATA_PATH_TO_EYES_RESULTS_NAME] = (
+            self.results_dir or self.path_to_test_results
+        )
+        if self.robot_output_dir is None:
+            # Robot variables are not available anymore when listener is closed
+            self.robot_output_dir = BuiltIn().get_variable_value("${OUTPUT DIR}")
+            log_file = BuiltIn().get_variable_value("${LOG FILE}")
+            if log_file and log_file.upper() != "NONE":
+                self.robot_log_dir = os.path.dirname(log_file)
 
     def register_robot_test_started(self, data, result):
         # type: (TestSuite,TestSuite) -> None
@@ -155,44 +484,389 @@ class EyesToRobotTestResultsManager(object):
         self.test_id_to_suite[self.configure.user_test_id] = result
         self.configure.user_test_id = None
 
-    def get_test_image_html(self, test_results_summary, user_test_id, step_index):
-        # Load test configuration, so the API Key can be used as a 'view key' to download images for html report
-        lib_component = LibraryComponent(self)
-        test_config = lib_component.get_configuration()
-        test_image_html = ''
-        for test_result in test_results_summary.results:
-            if(test_result.user_test_id == user_test_id):
-                base64_test_result_handler = ApplitoolsBase64TestResultHandler(test_result.test_results, test_config.api_key)
-                test_image_html += base64_test_result_handler.get_base64_table_rows_html(step_index + 1) # Get html with embedded base64 images
-        return test_image_html
+    def get_session_handler(self, test_results):
+        # type: (TestResults) -> ApplitoolsBase64TestResultHandler
+        """Return handler of the session, created once per (batch_id, session_id)
+        and reused by all the steps of the session during the close phase"""
+        session_key = ApplitoolsBase64TestResultHandler.get_session_key(test_results)
+        handler = self.session_handlers.get(session_key)
+        if handler is None:
+            if session_key in self.failed_sessions:
+                raise self.failed_sessions[session_key]
+            # Load test configuration, so the API Key can be used as a 'view key' to download images for html report
+            test_config = LibraryComponent(self).get_configuration()
+            try:
+                handler = ApplitoolsBase64TestResultHandler(
+                    test_results,
+                    test_config.api_key,
+                    http_session=get_shared_session(),
+                    downloader=get_shared_downloader(),
+                    image_cache=get_shared_image_cache(),
+                    options=self.configure.test_results_handler,
+                    report_assets=get_shared_report_assets(),
+                    test_json=self.preloaded_test_json.pop(session_key, None),
+                )
+            except Exception as e:
+                # may run on harvester thread, warned about when the session is rendered
+                self.failed_sessions[session_key] = e
+                raise
+            self.session_handlers[session_key] = handler
+        return handler
+
+    def should_report_images(self, test_results, step_index=None):
+        # type: (TestResults, Optional[int]) -> bool
+        """Decide by `report_images` policy from data already returned by SDK,
+        so tests without images in report cost no requests"""
+        policy = self.configure.test_results_handler.report_images
+        if policy is ReportImages.all:
+            return True
+        if policy is ReportImages.failed_only:
+            return test_results.status != TestResultsStatus.Passed
+        if policy is ReportImages.diffs_only:
+            if step_index is None:
+                return any(step.is_different for step in test_results.steps_info)
+            return test_results.steps_info[step_index].is_different
+        return False
+
+    def get_test_image_html(self, user_test_id, step_index):
+        # type: (Text, int) -> Text
+        # Get html with embedded base64 images
+        return "".join(
+            itertools.chain.from_iterable(
+                self.iter_step_image_html(test_results, step_index)
+                for test_results in self.user_test_id_to_test_results[user_test_id]
+                if self.should_report_images(test_results, step_index)
+            )
+        )
+
+    def iter_step_image_html(self, test_results, step_index):
+        # type: (TestResults, int) -> Iterable[Text]
+        try:
+            handler = self.get_session_handler(test_results)
+        except Exception as e:
+            # session JSON is unavailable, warned about once per session
+            session_key = ApplitoolsBase64TestResultHandler.get_session_key(test_results)
+            if session_key not in self.reported_failed_sessions:
+                self.reported_failed_sessions.add(session_key)
+                robot_logger.warn(
+                    "Failed to retrieve Eyes session of {}, linking its steps "
+                    "in dashboard instead: {}".format(test_results.url, e)
+                )
+            return ApplitoolsBase64TestResultHandler.iter_step_links_table_html(
+                test_results, step_index + 1
+            )
+        return handler.iter_base64_table_rows_html(step_index + 1)
+
+    def init_shared_services(self):
+        # type: () -> None
+        get_shared_session(self.configure.test_results_handler)
+        get_shared_downloader(self.configure.test_results_handler)
+        get_shared_image_cache(self.configure.test_results_handler)
+        options = self.configure.test_results_handler
+        if options.report_image_format is not None or (
+            options.thumbnail_max_size
+            and options.report_image_storage is ReportImageStorage.assets
+        ):
+            get_shared_image_encoder(options)
+        if (
+            self.configure.test_results_handler.report_image_storage
+            is ReportImageStorage.assets
+        ):
+            get_shared_report_assets(
+                self.configure.test_results_handler,
+                self.robot_output_dir or os.getcwd(),
+                self.robot_log_dir,
+            )
+
+    def is_harvesting_enabled(self):
+        # type: () -> bool
+        """Harvested images are kept in the image cache or report assets until
+        the listener close, without one of them harvesting is disabled"""
+        options = self.configure.test_results_handler
+        if not options.harvest_results_on_test_end:
+            return False
+        enabled = bool(
+            options.image_cache_dir
+            or options.report_image_storage is ReportImageStorage.assets
+        )
+        if not self.harvest_warned:
+            self.harvest_warned = True
+            if enabled:
+                robot_logger.warn(
+                    "test_results_handler.harvest_results_on_test_end makes "
+                    "`Eyes Close Async` wait for the results of each test"
+                )
+            else:
+                robot_logger.warn(
+                    "test_results_handler.harvest_results_on_test_end requires image_cache_dir "
+                    "or report_image_storage: assets, results are retrieved at the end of the run"
+                )
+        return enabled
+
+    def register_eyes_test_closed(self, test_results):
+        # type: (Optional[TestResults]) -> None
+        """Start retrieving results of a test closed during the run on
+        background worker, so less work is left for the listener close"""
+        if (
+            test_results is None
+            or not self.configure.propagate_eyes_test_results
+            or not self.should_report_images(test_results)
+        ):
+            return
+        if self.harvester is None:
+            self.harvester = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="EyesResultsHarvester"
+            )
+        self.harvester.submit(self.harvest_test_results, test_results)
+
+    def harvest_test_results(self, test_results):
+        # type: (TestResults) -> None
+        try:
+            self.init_shared_services()
+            self.get_session_handler(test_results).harvest_images()
+        except Exception as e:
+            # retrieved again at listener close
+            log.debug("Failed to harvest Eyes results of {}: {}".format(test_results.url, e))
+
+    def finish_harvesting(self):
+        # type: () -> None
+        if self.harvester is not None:
+            self.harvester.shutdown(wait=True)
+            self.harvester = None
 
     def register_eyes_test_results_on_close(self, test_results_summary):
         # type: (TestResultsSummary) -> None
         if not self.configure.propagate_eyes_test_results:
             return
-        suites = defaultdict(list)
+        # handlers of tests harvested during the run are reused
+        self.finish_harvesting()
+        # sessions failed during the run are retrieved again
+        self.failed_sessions = {}
+        self.init_shared_services()
+        get_shared_session().reset_deadline(
+            self.configure.test_results_handler.results_retrieval_timeout
+        )
+        self.user_test_id_to_test_results = defaultdict(list)
+        for test_result in test_results_summary.results:
+            if test_result.test_results is not None:
+                self.user_test_id_to_test_results[test_result.user_test_id].append(
+                    test_result.test_results
+                )
+        self.prefetch_test_images()
+        # every test is written as soon as its html is built
+        writer = self.create_results_writer()
 
         for test_results in self.process_test_results(test_results_summary):
+            if self.async_retriever is not None:
+                # rendering then costs no requests
+                self.async_retriever.wait(test_results.user_test_id)
             robot_test_name = self.test_id_to_suite[test_results.user_test_id].name
             robot_test_suite_name = self.test_id_to_suite[
                 test_results.user_test_id
             ].parent.name
-            suites[robot_test_suite_name].append(
+            writer.append(
+                robot_test_suite_name,
                 dict(
                     test_name=robot_test_name,
                     test_status=EYES_STATUS_TO_ROBOT_STATUS[test_results.status],
                     test_results_url=test_results.url,
                     steps=[
-                        dict(
-                            is_different=step.is_different,
-                            url=step.app_urls.step,
-                            step_result_html=self.get_test_image_html(test_results_summary, test_results.user_test_id, step_index)
-                        )
+                        self.get_step_info(test_results, step_index, step)
                         for step_index,step in enumerate(test_results.steps_info)
                     ]
+                ),
+            )
+            self.release_test_images(test_results.user_test_id)
+        writer.close()
+        for handler in self.session_handlers.values():
+            self.long_request_wait_times.update(handler.long_request_wait_times)
+        self.log_long_request_wait_times(self.long_request_wait_times)
+        self.long_request_wait_times = {}
+        self.session_handlers = {}
+        self.failed_sessions = {}
+        self.reported_failed_sessions = set()
+        self.preloaded_test_json = {}
+        self.user_test_id_to_test_results = defaultdict(list)
+        self.prefetch_queue.clear()
+        self.prefetched_test_ids.clear()
+        if self.async_retriever is not None:
+            self.async_retriever.close()
+        self.async_retriever = None
+        close_shared_downloader()
+        close_shared_report_assets()
+        close_shared_image_encoder()
+        self.log_image_cache_stats(close_shared_image_cache())
+        self.log_connection_stats(close_shared_session())
+
+    def get_step_info(self, test_results, step_index, step):
+        # type: (TestResults, int, Any) -> dict
+        step_info = dict(is_different=step.is_different, url=step.app_urls.step)
+        step_result_html = self.get_test_image_html(test_results.user_test_id, step_index)
+        # steps skipped by `report_images` policy get no message
+        if step_result_html:
+            step_info["step_result_html"] = step_result_html
+        return step_info
+
+    def create_results_writer(self):
+        # type: () -> Union[JsonLinesResultsWriter, SqliteResultsStore]
+        if self.configure.test_results_handler.results_format is ResultsFormat.sqlite:
+            if os.path.exists(self.path_to_test_results):
+                # results of previous close are overwritten as by other formats
+                os.remove(self.path_to_test_results)
+            return SqliteResultsStore(self.path_to_test_results)
+        return JsonLinesResultsWriter(self.path_to_test_results)
+
+    def prefetch_test_images(self):
+        # type: () -> None
+        """Queue images of the first `prefetch_window` tests to the download pool,
+        so they are fetched concurrently while step html is being built"""
+        test_results_list = [
+            test_results
+            for test_results in itertools.chain.from_iterable(
+                self.user_test_id_to_test_results.values()
+            )
+            if self.should_report_images(test_results)
+        ]
+        handler_options = self.configure.test_results_handler
+        test_config = LibraryComponent(self).get_configuration()
+        self.preloaded_test_json = SessionJsonLoader(
+            test_config.api_key,
+            get_shared_session(),
+            handler_options.max_workers,
+            get_shared_image_cache(),
+        ).load(
+            [
+                test_results
+                for test_results in test_results_list
+                if ApplitoolsBase64TestResultHandler.get_session_key(test_results)
+                not in self.session_handlers
+            ]
+        )
+        if handler_options.backend is TestResultsBackend.asyncio:
+            self.async_retriever = AsyncResultsRetriever(
+                test_config.api_key,
+                get_shared_session(),
+                get_shared_downloader(),
+                handler_options,
+                self.session_handlers,
+                self.preloaded_test_json,
+            )
+            # all sessions are polled at once under one event loop, images
+            # are held for `prefetch_window` tests ahead of rendering
+            self.async_retriever.start(
+                (
+                    user_test_id,
+                    [
+                        test_results
+                        for test_results in test_results_list
+                        if self.should_report_images(test_results)
+                    ],
+                )
+                for user_test_id, test_results_list in self.user_test_id_to_test_results.items()
+            )
+            return
+        # tests are rendered in the order of `user_test_id_to_test_results`
+        self.prefetch_queue = deque(self.user_test_id_to_test_results.keys())
+        self.prefetched_test_ids = set()
+        self.prefetch_ahead()
+
+    def prefetch_ahead(self):
+        # type: () -> None
+        """Keep images of at most `prefetch_window` tests ahead of rendering,
+        so memory doesn't grow with the number of tests"""
+        test_results_list = []
+        while (
+            self.prefetch_queue
+            and len(self.prefetched_test_ids)
+            < self.configure.test_results_handler.prefetch_window
+        ):
+            user_test_id = self.prefetch_queue.popleft()
+            self.prefetched_test_ids.add(user_test_id)
+            test_results_list.extend(
+                test_results
+                for test_results in self.user_test_id_to_test_results[user_test_id]
+                if self.should_report_images(test_results)
+            )
+        if not test_results_list:
+            return
+        for test_results in test_results_list:
+            try:
+                self.get_session_handler(test_results).prefetch_base64_images()
+            except Exception as e:
+                # failed sessions are reported when rendered
+                robot_logger.debug(
+                    "Failed to prefetch Eyes images of {}: {}".format(test_results.url, e)
                 )
+
+    def release_test_images(self, user_test_id):
+        # type: (Text) -> None
+        """Drop handlers and images of the written test left in the download
+        pool and start prefetching the next test"""
+        for test_results in self.user_test_id_to_test_results[user_test_id]:
+            session_key = ApplitoolsBase64TestResultHandler.get_session_key(test_results)
+            self.preloaded_test_json.pop(session_key, None)
+            handler = self.session_handlers.pop(session_key, None)
+            if handler is not None:
+                handler.release_prefetched_images()
+                self.long_request_wait_times.update(handler.long_request_wait_times)
+        if self.async_retriever is not None:
+            self.async_retriever.release(user_test_id)
+            return
+        if user_test_id in self.prefetched_test_ids:
+            self.prefetched_test_ids.discard(user_test_id)
+        else:
+            # rendered before its turn, not prefetched anymore
+            try:
+                self.prefetch_queue.remove(user_test_id)
+            except ValueError:
+                pass
+        self.prefetch_ahead()
+
+    @staticmethod
+    def log_long_request_wait_times(wait_times):
+        # type: (dict[Text, float]) -> None
+        if not wait_times:
+            return
+        for url, waited in wait_times.items():
+            robot_logger.debug(
+                "Eyes long request {} waited {:.1f} s".format(url, waited)
             )
-        save_suites(self.path_to_test_results, suites)
+        robot_logger.info(
+            "Eyes test results download: {} long requests waited {:.1f} s "
+            "in total".format(len(wait_times), sum(wait_times.values()))
+        )
+
+    @staticmethod
+    def log_image_cache_stats(image_cache):
+        # type: (Optional[ImageCache]) -> None
+        if image_cache is None:
+            return
+        robot_logger.info(
+            "Eyes image cache {}: {} hits, {} misses".format(
+                image_cache.directory, image_cache.hits, image_cache.misses
+            )
+        )
+
+    @staticmethod
+    def log_connection_stats(stats):
+        # type: (Optional[dict]) -> None
+        if stats is None:
+            return
+        robot_logger.info(
+            "Eyes test results download: {requests} requests over "
+            "{connections_opened} connections, {connections_reused} "
+            "reused".format(**stats)
+        )
+        message = (
+            "Eyes test results download: {retries} retries, {retries_denied} "
+            "retries over budget, circuit {circuit_state} (opened "
+            "{circuit_opened} times, {requests_rejected} requests "
+            "rejected)".format(**stats)
+        )
+        if stats["circuit_opened"]:
+            robot_logger.warn(message)
+        else:
+            robot_logger.info(message)
 
     @staticmethod
     def process_test_results(test_results_summary):